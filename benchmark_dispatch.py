@@ -0,0 +1,85 @@
+from sys import argv
+from timeit import timeit
+
+from core.handlers.cancel import cancel_command
+from core.handlers.slave.ban import ban_command, unban_command, ban_list_command
+from core.handlers.slave.help import help_command
+from core.handlers.slave.pollslist import polls_list_command
+from core.handlers.slave.post import cbq_message_review, cbq_cancel_publishing
+from core.handlers.slave.reject import reject_command
+from core.handlers.slave.reply import reply_command
+from core.handlers.slave.setallowed import change_allowed_command
+from core.handlers.slave.setdelay import setdelay_command
+from core.handlers.slave.setfreqlimit import setfreqlimit_command
+from core.handlers.slave.setlanguage import setlanguage
+from core.handlers.slave.setstartmessage import setstartmessage_command
+from core.handlers.slave.settextlimits import settextlimits_command
+from core.handlers.slave.settimeout import settimeout_command
+from core.handlers.slave.setvotes import setvotes_command
+from core.handlers.slave.start import start_command
+from core.handlers.slave.stats import stats_command
+from core.handlers.slave.toggle_power import togglepower_command
+from core.handlers.slave.toggle_selfvote import toggleselfvote_command
+from core.handlers.slave.toggle_start_web_preview import toggle_start_web_preview_command
+from core.handlers.slave.toggle_tag_polls import toggletagpolls_command
+from core.handlers.slave.toggle_vote import togglevote_command
+from core.handlers.slave.toggle_vote_switch import togglevoteswitch_command
+from core.handlers.slave.vote import vote_new, vote_old
+from core.settings import DEFAULT_SLAVE_SETTINGS
+
+# Handlers covered by the router, in the Slave._init_handlers order
+HANDLERS = [cancel_command, start_command, vote_new, vote_old, setlanguage, ban_command, unban_command,
+            ban_list_command, reject_command, reply_command, setdelay_command, setstartmessage_command,
+            settimeout_command, setvotes_command, settextlimits_command, setfreqlimit_command, change_allowed_command,
+            togglepower_command, togglevote_command, toggleselfvote_command, toggle_start_web_preview_command,
+            togglevoteswitch_command, toggletagpolls_command, stats_command, help_command, polls_list_command,
+            cbq_message_review, cbq_cancel_publishing]
+
+MODERATOR_CHAT_ID = -1001
+USER_ID = 1002
+
+
+class FakeBot:
+    # Updates below come from a regular user in a private chat, so every filter says no and nothing touches the DB
+    id = bot_id = 1000
+    owner_id = 1
+    moderator_chat_id = MODERATOR_CHAT_ID
+    administrators = [1]
+    settings = dict(DEFAULT_SLAVE_SETTINGS, power=False)
+
+
+def message(text):
+    return {'message': {'message_id': 1, 'chat': {'id': USER_ID, 'type': 'private'}, 'from': {'id': USER_ID},
+                        'text': text}}
+
+
+def callback_query(data):
+    return {'callback_query': {'id': '1', 'data': data, 'from': {'id': USER_ID},
+                               'message': {'message_id': 1, 'chat': {'id': USER_ID}}}}
+
+
+UPDATES = [
+    message('Hello, please publish this'),
+    message('/stats'),
+    message('/vote_1002_1_yes'),
+    callback_query('vote_1002_1_yes'),
+    callback_query('ban_1002_1002_1'),
+    callback_query('reply_1002_1'),
+]
+
+
+def dispatch(handlers, update):
+    for handler in handlers:
+        handler(FakeBot, **update).result()
+
+
+if __name__ == '__main__':
+    iterations = int(argv[1]) if len(argv) > 1 else 10000
+    unrouted = [handler.__wrapped__ for handler in HANDLERS]
+
+    print('%d handlers, %d iterations per update' % (len(HANDLERS), iterations))
+    for update in UPDATES:
+        filters_time = timeit(lambda: dispatch(unrouted, update), number=iterations) / iterations
+        router_time = timeit(lambda: dispatch(HANDLERS, update), number=iterations) / iterations
+        print('%-50s filters: %7.2fus  router: %7.2fus  x%.1f' % (repr(update)[:50], filters_time * 1e6,
+                                                                   router_time * 1e6, filters_time / router_time))
@@ -9,6 +9,7 @@ from tornado import autoreload
 from os import environ
 
 from core.boterator import Boterator
+from core.migrations import apply_migrations
 
 
 if __name__ == '__main__':
@@ -16,6 +17,7 @@ if __name__ == '__main__':
     define('db', type=str, help='DB connection DSN', default=environ.get('DB', "dbname=boterator user=boterator host=localhost port=5432"))
     define('burlesque', type=str, help='Burlesque address', default=environ.get('BURLESQUE', 'http://127.0.0.1:4401'))
     define('debug', type=bool, default=False)
+    define('migrate', type=bool, help='Apply new DB migrations on startup', default=environ.get('MIGRATE', '1') == '1')
 
     parse_command_line()
 
@@ -23,6 +25,9 @@ if __name__ == '__main__':
         print_help()
         exit(1)
 
+    if options.migrate:
+        apply_migrations(options.db)
+
     ioloop = IOLoop.instance()
 
     db = Pool(dsn=options.db, size=1, max_size=10, auto_shrink=True, ioloop=IOLoop.current())
@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta
+from json import loads
+from os import environ
+from sys import argv, exit
+
+import psycopg2
+
+# Seeded rows belong to bots with negative ids, everything is rolled back at the end anyway
+BOTS = 50
+MESSAGES_PER_BOT = 2000
+USERS_PER_BOT = 500
+BOT_ID = -1
+# Lower bound of the open polls, the older partitions have to be pruned
+SINCE = datetime.now() - timedelta(days=1)
+# Partitions a query on a partitioned table may scan
+MAX_PARTITIONS = 2
+
+SEED = [
+    "SELECT create_monthly_partitions('incoming_messages', CURRENT_DATE - 90, CURRENT_DATE)",
+    "SELECT create_monthly_partitions('votes_history', CURRENT_DATE - 90, CURRENT_DATE)",
+    """
+    INSERT INTO incoming_messages (id, original_chat_id, owner_id, bot_id, created_at, is_voting_success,
+                                   is_voting_fail, is_published, message)
+    SELECT m, 1000 + m %% %(users)s, 1000 + m %% %(users)s, -b, NOW() - m * INTERVAL '10 minutes', m > 20,
+           m > 20 AND m %% 3 = 0, m > 20 AND m %% 3 <> 0, '{}'::JSONB
+    FROM generate_series(1, %(bots)s) b, generate_series(1, %(messages)s) m
+    """,
+    """
+    INSERT INTO incoming_message_keys (bot_id, original_chat_id, id, created_at)
+    SELECT bot_id, original_chat_id, id, created_at FROM incoming_messages WHERE bot_id < 0
+    """,
+    """
+    INSERT INTO votes_history (bot_id, user_id, message_id, original_chat_id, vote_yes, created_at, message_created_at)
+    SELECT im.bot_id, v, im.id, im.original_chat_id, v <> 2, im.created_at, im.created_at
+    FROM incoming_messages im, generate_series(1, 3) v
+    WHERE im.bot_id < 0
+    """,
+    """
+    INSERT INTO users (bot_id, user_id, first_name, created_at, updated_at, banned_at)
+    SELECT -b, 1000 + u, 'User', NOW(), NOW(), CASE WHEN u %% 50 = 0 THEN NOW() END
+    FROM generate_series(1, %(bots)s) b, generate_series(0, %(users)s - 1) u
+    """,
+    'ANALYZE incoming_message_keys',
+    'ANALYZE incoming_messages',
+    'ANALYZE votes_history',
+    'ANALYZE users',
+    'ANALYZE stats_daily',
+]
+
+# (name, query, params, checked table, acceptable indexes), queries are the same as in the code. Tables and indexes of
+# the partitions are reported under the names of their parents.
+HOT_QUERIES = [
+    ('cast_vote: message key', 'SELECT created_at FROM incoming_message_keys '
+                               'WHERE bot_id = %s AND original_chat_id = %s AND id = %s',
+     (BOT_ID, 1001, 1), 'incoming_message_keys', {'incoming_message_keys_pkey'}),
+    ('cast_vote: message lock', 'SELECT * FROM incoming_messages '
+                                'WHERE bot_id = %s AND original_chat_id = %s AND id = %s AND created_at = %s '
+                                'FOR UPDATE',
+     (BOT_ID, 1001, 1, SINCE), 'incoming_messages', {'incoming_messages_pkey'}),
+    ('cast_vote: previous vote', 'SELECT vote_yes FROM votes_history '
+                                 'WHERE bot_id = %s AND original_chat_id = %s AND message_id = %s AND user_id = %s '
+                                 'AND message_created_at = %s',
+     (BOT_ID, 1001, 1, 1, SINCE), 'votes_history', {'votes_history_bmou_uniq'}),
+    ('polls_since', 'SELECT COALESCE(MIN(created_at), LOCALTIMESTAMP) FROM incoming_messages '
+                    'WHERE bot_id = %s AND is_published = FALSE AND is_voting_fail = FALSE AND created_at >= %s',
+     (BOT_ID, SINCE), 'incoming_messages', {'im_pending_idx', 'im_pending_die_idx'}),
+    ('pending publication', 'SELECT message, moderation_message_id, created_at FROM incoming_messages '
+                            'WHERE bot_id = %s AND is_voting_success = TRUE AND is_published = FALSE '
+                            'AND created_at >= %s ORDER BY created_at LIMIT 1',
+     (BOT_ID, SINCE), 'incoming_messages', {'im_pending_idx'}),
+    ('pending polls', 'SELECT original_chat_id, id FROM incoming_messages WHERE is_voting_success = False AND '
+                      'is_voting_fail = False AND is_published = False AND bot_id = %s AND created_at >= %s '
+                      'ORDER BY created_at ASC',
+     (BOT_ID, SINCE), 'incoming_messages', {'im_pending_idx', 'im_pending_die_idx'}),
+    ('expired polls', 'SELECT im.bot_id, im.created_at, im.message, im.yes_count FROM incoming_messages im '
+                      'JOIN unnest(%s::BIGINT[], %s::TIMESTAMP[], %s::TIMESTAMP[]) AS b (bot_id, expire_before, since) '
+                      'ON b.bot_id = im.bot_id WHERE im.is_voting_success = FALSE AND im.is_voting_fail = FALSE '
+                      'AND im.created_at <= b.expire_before AND im.created_at >= b.since AND im.created_at >= %s '
+                      'ORDER BY im.bot_id, im.created_at DESC LIMIT 500',
+     ([BOT_ID], [datetime.now()], [SINCE], SINCE), 'incoming_messages', {'im_pending_die_idx', 'im_pending_idx'}),
+    ('check_freq', "SELECT EXTRACT(EPOCH FROM NOW() - created_at) FROM incoming_messages "
+                   "WHERE bot_id = %s AND owner_id = %s AND created_at >= NOW() - %s * INTERVAL '1 day' "
+                   "ORDER BY created_at DESC LIMIT %s",
+     (BOT_ID, 1001, 7, 10), 'incoming_messages', {'im_owner_idx'}),
+    ('validate_user', 'SELECT banned_at FROM users WHERE bot_id = %s AND user_id = %s',
+     (BOT_ID, 1001), 'users', {'users_pkey'}),
+    ('banned users', 'SELECT user_id FROM users WHERE bot_id = %s AND banned_at IS NOT NULL',
+     (BOT_ID,), 'users', {'users_banned_idx'}),
+    ('stats', 'SELECT user_id, SUM(votes), SUM(messages) FROM stats_daily '
+              'WHERE bot_id = %s AND day BETWEEN %s AND %s GROUP BY user_id',
+     (BOT_ID, '2000-01-01', '2100-01-01'), 'stats_daily', {'stats_daily_pkey'}),
+]
+
+
+def parent_names(cur, names):
+    cur.execute('SELECT c.relname, p.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                'JOIN pg_class p ON p.oid = i.inhparent WHERE c.relname = ANY(%s)', (list(names),))
+    parents = dict(cur.fetchall())
+    return {name: parents.get(name, name) for name in names}
+
+
+def plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def check_plan(cur, query, params, table, indexes):
+    cur.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = loads(plan)
+
+    nodes = list(plan_nodes(plan[0]['Plan']))
+    relations = parent_names(cur, {node['Relation Name'] for node in nodes if 'Relation Name' in node})
+    index_names = parent_names(cur, {node['Index Name'] for node in nodes if 'Index Name' in node})
+    seq_scans = [node for node in nodes
+                 if node['Node Type'] == 'Seq Scan' and relations.get(node.get('Relation Name')) == table]
+    partitions = sum(1 for name, parent in relations.items() if parent == table and name != table)
+    used = set(index_names.values())
+    return not seq_scans and bool(used & indexes) and partitions <= MAX_PARTITIONS, used, partitions
+
+
+if __name__ == '__main__':
+    dsn = argv[1] if len(argv) > 1 else environ.get('DB', 'dbname=boterator user=boterator host=localhost port=5432')
+    conn = psycopg2.connect(dsn)
+    failed = 0
+    try:
+        with conn.cursor() as cur:
+            for query in SEED:
+                cur.execute(query, dict(bots=BOTS, messages=MESSAGES_PER_BOT, users=USERS_PER_BOT))
+
+            for name, query, params, table, indexes in HOT_QUERIES:
+                ok, used, partitions = check_plan(cur, query, params, table, indexes)
+                failed += not ok
+                scanned = ', %d partitions scanned (%d allowed)' % (partitions, MAX_PARTITIONS) if partitions else ''
+                print('%-4s %-25s uses %s, expected one of %s%s' % ('ok' if ok else 'FAIL', name,
+                                                                    ', '.join(sorted(used)) or 'no indexes',
+                                                                    ', '.join(sorted(indexes)), scanned))
+    finally:
+        conn.rollback()
+        conn.close()
+
+    exit(1 if failed else 0)
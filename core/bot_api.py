@@ -0,0 +1,37 @@
+from ujson import dumps, loads
+
+from tornado.gen import coroutine
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+API_URL = 'https://api.telegram.org/bot{token}/{method}'
+
+# Everything our handlers react on
+ALLOWED_UPDATES = ['message', 'callback_query']
+
+
+class BotApiError(Exception):
+    # Same attributes as tobot's ApiError, so both can be handled the same way
+    def __init__(self, code, description, parameters=None, request_body=''):
+        super().__init__('%s: %s' % (code, description))
+        self.code = code
+        self.description = description
+        self.parameters = parameters or {}
+        self.request_body = request_body
+
+
+@coroutine
+def call_api(token, method, request_timeout=20, **params):
+    body = dumps(params)
+    request = HTTPRequest(API_URL.format(token=token, method=method), method='POST', body=body,
+                          headers={'Content-Type': 'application/json'}, request_timeout=request_timeout)
+    response = yield AsyncHTTPClient().fetch(request, raise_error=False)
+    try:
+        data = loads(response.body.decode('utf-8')) if response.body else {}
+    except ValueError:
+        data = {}
+
+    if not data.get('ok'):
+        raise BotApiError(data.get('error_code', response.code), data.get('description', str(response.error)),
+                          data.get('parameters'), body)
+
+    return data['result']
@@ -4,7 +4,6 @@ from ujson import loads, dumps
 from tornado.gen import coroutine
 
 from tobot import Base
-from tobot.stages import PersistentStages
 from core.handlers.cancel import cancel_command
 from core.handlers.boterator.reg import reg_command, plaintext_token, plaintext_channel_name, \
     plaintext_set_start_message, change_start_command, plaintext_set_hello, change_hello_command
@@ -15,17 +14,21 @@ from core.handlers.boterator.setlanguage_at_start import setlanguage_at_start, s
 from core.handlers.unknown_command import unknown_command
 from core.handlers.validate_user import validate_user
 from core.queues import boterator_queues, QUEUE_BOTERATOR_BOT_REVOKE
+from core.scheduler import JobScheduler
+from core.stages import StagesStore
 from tobot.helpers import pgettext
 from tobot.telegram import Api
 
 
 class Boterator(Base):
     SETTINGS_TYPE = Base.SETTINGS_PER_USER
+    STAGES_SWEEP_INTERVAL = 3600
 
     def __init__(self, token, db, queue, **kwargs):
         self.db = db
-        super().__init__(token, stages_builder=lambda bot_id: PersistentStages(bot_id, db), ignore_403_in_handlers=True,
-                         **kwargs)
+        self.stages_store = StagesStore(db)
+        self.scheduler = JobScheduler()
+        super().__init__(token, stages_builder=self.stages_store.stages, ignore_403_in_handlers=True, **kwargs)
         self.queue = queue
 
     @coroutine
@@ -78,11 +81,14 @@ class Boterator(Base):
     @coroutine
     def start(self):
         queue_listen_f = self.queue.listen(boterator_queues(), self.queue_handler)
+        self.scheduler.add(('stages_sweep',), self.stages_store.sweep, self.STAGES_SWEEP_INTERVAL)
         try:
             yield super().start()
         finally:
+            self.scheduler.remove(('stages_sweep',))
             self.queue.stop(boterator_queues())
             yield queue_listen_f
+            yield self.stages_store.flush()
 
     @coroutine
     def queue_handler(self, queue_name, body):
@@ -0,0 +1,46 @@
+from collections import OrderedDict
+from time import time
+
+
+class LRUCache:
+    """
+    Size-bounded dict evicting the least recently used keys. Entries older than `ttl` seconds are treated as missing,
+    so the caller has to re-read them from the DB.
+    """
+
+    def __init__(self, capacity, ttl=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+
+        value, stored_at = entry
+        if self.ttl is not None and time() - stored_at > self.ttl:
+            del self._data[key]
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time())
+        self._data.move_to_end(key)
+        while len(self._data) > self.capacity:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        self._data.clear()
@@ -3,8 +3,10 @@ from tornado.gen import coroutine
 from tobot import CommandFilterTextCmd
 from tobot.helpers import pgettext
 from tobot.telegram import ReplyKeyboardHide
+from core.update_router import router
 
 
+@router.route(command='/cancel')
 @coroutine
 @CommandFilterTextCmd('/cancel')
 def cancel_command(bot, message, **kwargs):
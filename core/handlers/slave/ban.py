@@ -3,10 +3,12 @@ from tornado.gen import coroutine
 from tobot import CommandFilterTextRegexp, CommandFilterTextCmd, CommandFilterTextAny, \
     CommandFilterCallbackQueryRegexp
 from core.slave_command_filters import CommandFilterIsModerationChat
+from core.update_router import router
 from tobot.helpers import report_botan, pgettext
 from tobot.telegram import ForceReply
 
 
+@router.route(callback='ban_')
 @coroutine
 @CommandFilterIsModerationChat()
 @CommandFilterCallbackQueryRegexp(r'ban_(?P<user_id>\d+)(?:_(?P<chat_id>\d+)_(?P<message_id>\d+))?')
@@ -30,6 +32,8 @@ def ban_command(bot, callback_query, user_id, chat_id=None, message_id=None):
         yield bot.answer_callback_query(callback_query['id'], pgettext('User already banned', 'User already banned'))
         return None
 
+    answered = bot.answer_callback_query(callback_query['id']) if bot.early_callback_answer else None
+
     msg = pgettext('Ban reason request', 'Please enter a ban reason for the user, @{moderator_username}')\
         .format(moderator_username=callback_query['from']['username'])
 
@@ -40,7 +44,7 @@ def ban_command(bot, callback_query, user_id, chat_id=None, message_id=None):
 
     yield bot.send_message(msg, chat_id=bot.moderator_chat_id, reply_markup=ForceReply(True),
                            reply_to_message_id=fwd_id)
-    yield bot.answer_callback_query(callback_query['id'])
+    yield answered or bot.answer_callback_query(callback_query['id'])
     return {
         'user_id': user_id
     }
@@ -66,8 +70,14 @@ def plaintext_ban_handler(bot, message, user_id):
                                                                 'try again or send /cancel'),
                                reply_to_message=message, reply_markup=ForceReply(True))
     else:
-        report_botan(message, 'slave_ban_success')
         yield bot.send_chat_action(chat_id, bot.CHAT_ACTION_TYPING)
+        banned = yield bot.update_user_ban(user_id, True, msg)
+        if not banned:
+            yield bot.send_message(pgettext('Ban failed', 'Unable to ban the user, try again later'),
+                                   reply_to_message=message)
+            return True
+
+        report_botan(message, 'slave_ban_success')
         try:
             yield bot.send_message(pgettext('Message to user in case of ban',
                                             "You've been banned from further communication with this bot. "
@@ -76,28 +86,31 @@ def plaintext_ban_handler(bot, message, user_id):
         except:
             pass
         cur = yield bot.db.execute('SELECT message FROM incoming_messages WHERE bot_id = %s AND owner_id = %s AND '
-                                   'is_voting_success = FALSE AND is_voting_fail = FALSE AND is_published = FALSE',
-                                   (bot.id, user_id,))
+                                   'is_voting_success = FALSE AND is_voting_fail = FALSE AND is_published = FALSE AND '
+                                   'created_at >= %s', (bot.id, user_id, bot.polls_since))
         while True:
             row = cur.fetchone()
             if not row:
                 break
             yield bot.decline_message(row[0], 0, False)
 
-        yield bot.db.execute('UPDATE users SET banned_at = NOW(), ban_reason = %s WHERE user_id = %s AND '
-                             'bot_id = %s', (msg, user_id, bot.id))
         yield bot.send_message(pgettext('Ban confirmation', 'User banned'), reply_to_message=message)
 
         return True
 
 
+@router.route(command='/unban_')
 @coroutine
 @CommandFilterIsModerationChat()
 @CommandFilterTextRegexp(r'/unban_(?P<user_id>\d+)')
 def unban_command(bot, message, user_id):
     report_botan(message, 'slave_unban_cmd')
-    yield bot.db.execute('UPDATE users SET banned_at = NULL, ban_reason = NULL WHERE user_id = %s AND '
-                         'bot_id = %s', (user_id, bot.id))
+    unbanned = yield bot.update_user_ban(user_id, False)
+    if not unbanned:
+        yield bot.send_message(pgettext('Unban failed', 'Unable to unban the user, try again later'),
+                               reply_to_message=message)
+        return
+
     yield bot.send_message(pgettext('Unban confirmation', 'User unbanned'), reply_to_message=message)
     try:
         yield bot.send_message(pgettext('User notification in case of unban', 'Access restored'),
@@ -106,6 +119,7 @@ def unban_command(bot, message, user_id):
         pass
 
 
+@router.route(command='/banlist')
 @coroutine
 @CommandFilterIsModerationChat()
 @CommandFilterTextCmd('/banlist')
@@ -1,23 +1,9 @@
-import datetime
 from tobot import CommandFilterAny
 from tobot.helpers import npgettext
 from tobot.helpers import pgettext
 from tornado.gen import coroutine
 
 
-@coroutine
-def get_messages_count(db, user_id, bot_id, days_limit):
-    d = datetime.datetime.now() - datetime.timedelta(days=days_limit)
-
-    query = """
-        SELECT COUNT(*) FROM incoming_messages
-        WHERE bot_id = %s AND owner_id = %s AND created_at >= %s
-    """
-
-    cur = yield db.execute(query, (bot_id, user_id, d))
-    return cur.fetchone()[0]
-
-
 @coroutine
 @CommandFilterAny()
 def check_freq(bot, **kwargs):
@@ -27,7 +13,7 @@ def check_freq(bot, **kwargs):
 
     fl = bot.settings['msg_freq_limit']
 
-    msgs = yield get_messages_count(bot.db, kwargs['message']['from']['id'], bot.bot_id, fl[1])
+    msgs = yield bot.messages_counter.count(kwargs['message']['from']['id'], fl[0], fl[1])
     if msgs < fl[0]:
         return False
 
@@ -24,4 +24,5 @@ def migrate_to_supergroup_msg(bot, *args, **kwargs):
 @coroutine
 def migrate(bot, new_chat_id):
     bot.moderator_chat_id = new_chat_id
-    yield bot.db.execute('UPDATE registered_bots SET moderator_chat_id = %s WHERE id = %s', (new_chat_id, bot.bot_id))
+    yield bot.db.execute('UPDATE registered_bots SET moderator_chat_id = %s, moderator_chat_type = NULL, '
+                         'moderator_chat_admins = NULL WHERE id = %s', (new_chat_id, bot.bot_id))
@@ -2,17 +2,19 @@ from tornado.gen import coroutine
 
 from tobot import CommandFilterTextCmd
 from core.slave_command_filters import CommandFilterIsModerationChat
+from core.update_router import router
 from tobot.helpers import pgettext, npgettext
 
 
+@router.route(command='/pollslist')
 @coroutine
 @CommandFilterTextCmd('/pollslist')
 @CommandFilterIsModerationChat()
 def polls_list_command(bot, message):
     cur = yield bot.db.execute('SELECT original_chat_id, id FROM incoming_messages WHERE '
                                'is_voting_success = False AND is_voting_fail = False AND is_published = False AND '
-                               'bot_id = %s ORDER BY created_at ASC',
-                               (bot.bot_id,))
+                               'bot_id = %s AND created_at >= %s ORDER BY created_at ASC',
+                               (bot.bot_id, bot.polls_since))
 
     pending = cur.fetchall()
 
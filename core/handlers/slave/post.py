@@ -6,6 +6,7 @@ from tornado.gen import coroutine
 
 from tobot import CommandFilterPrivate, CommandFilterTextAny, CommandFilterMultimediaAny, CommandFilterCallbackQuery
 from tobot.helpers import report_botan, pgettext
+from core.update_router import router
 
 
 @coroutine
@@ -100,16 +101,28 @@ def multimedia_post_handler(bot, message):
     }
 
 
+@router.route(callback='confirm_publishing')
 @coroutine
 @CommandFilterCallbackQuery('confirm_publishing')
 def cbq_message_review(bot, callback_query, sent_message):
     user_id = callback_query['from']['id']
 
     report_botan(callback_query, 'slave_confirm')
-    yield bot.db.execute("""
+    # incoming_message_keys keeps the messages unique across the partitions, a repeated confirmation inserts nothing
+    cur = yield bot.db.execute("""
+    WITH k AS (
+        INSERT INTO incoming_message_keys (bot_id, original_chat_id, id, created_at) VALUES (%s, %s, %s, NOW())
+        ON CONFLICT DO NOTHING
+        RETURNING bot_id, original_chat_id, id, created_at
+    )
     INSERT INTO incoming_messages (id, original_chat_id, owner_id, bot_id, created_at, message)
-    VALUES (%s, %s, %s, %s, NOW(), %s)
-    """, (sent_message['message_id'], sent_message['chat']['id'], user_id, bot.bot_id, dumps(sent_message)))
+    SELECT id, original_chat_id, %s, bot_id, created_at, %s FROM k
+    """, (bot.bot_id, sent_message['chat']['id'], sent_message['message_id'], user_id, dumps(sent_message)))
+    if not cur.rowcount:
+        yield bot.answer_callback_query(callback_query['id'])
+        return True
+
+    bot.messages_counter.add(user_id)
 
     bot.send_moderation_request(sent_message['chat']['id'], sent_message['message_id'])
 
@@ -123,6 +136,7 @@ def cbq_message_review(bot, callback_query, sent_message):
     return True
 
 
+@router.route(callback='cancel_publishing')
 @coroutine
 @CommandFilterCallbackQuery('cancel_publishing')
 def cbq_cancel_publishing(bot, callback_query, **kwargs):
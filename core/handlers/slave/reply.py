@@ -2,10 +2,12 @@ from tornado.gen import coroutine
 
 from tobot import CommandFilterTextAny, CommandFilterCallbackQueryRegexp
 from core.slave_command_filters import CommandFilterIsModerationChat
+from core.update_router import router
 from tobot.helpers import pgettext, report_botan
 from tobot.telegram import ForceReply
 
 
+@router.route(callback='reply_')
 @coroutine
 @CommandFilterIsModerationChat()
 @CommandFilterCallbackQueryRegexp(r'reply_(?P<chat_id>\d+)_(?P<message_id>\d+)')
@@ -13,10 +15,11 @@ def reply_command(bot, callback_query, chat_id, message_id):
     report_botan(callback_query, 'slave_reply_cmd')
     msg = pgettext('Reply message request', 'What message should I send to user, @{moderator_username}?') \
         .format(moderator_username=callback_query['from'].get('username', callback_query['from']['id']))
+    answered = bot.answer_callback_query(callback_query['id']) if bot.early_callback_answer else None
     fwd_id = yield bot.get_message_fwd_id(chat_id, message_id)
     yield bot.send_message(msg, chat_id=bot.moderator_chat_id, reply_markup=ForceReply(True),
                            reply_to_message_id=fwd_id)
-    yield bot.answer_callback_query(callback_query['id'])
+    yield answered or bot.answer_callback_query(callback_query['id'])
     return {
         'chat_id': chat_id,
         'message_id': message_id,
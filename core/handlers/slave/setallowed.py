@@ -5,6 +5,7 @@ from tornado.gen import coroutine
 
 from tobot import CommandFilterTextCmd
 from core.slave_command_filters import CommandFilterIsPowerfulUser
+from core.update_router import router
 from tobot.helpers import Emoji, pgettext, report_botan
 from tobot.telegram import ReplyKeyboardMarkup, KeyboardButton
 
@@ -41,6 +42,7 @@ def build_contenttype_keyboard(bot):
                                selective=True)
 
 
+@router.route(command='/setallowed')
 @coroutine
 @CommandFilterTextCmd('/setallowed')
 @CommandFilterIsPowerfulUser()
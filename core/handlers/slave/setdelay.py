@@ -2,10 +2,12 @@ from tornado.gen import coroutine
 
 from tobot import CommandFilterTextCmd
 from core.slave_command_filters import CommandFilterIsPowerfulUser
+from core.update_router import router
 from tobot.helpers import report_botan, pgettext
 from tobot.telegram import ForceReply
 
 
+@router.route(command='/setdelay')
 @coroutine
 @CommandFilterIsPowerfulUser()
 @CommandFilterTextCmd('/setdelay')
@@ -21,6 +23,7 @@ def plaintext_delay_handler(bot, message):
     if message['text'].isdigit() and int(message['text']) >= 0:
         report_botan(message, 'slave_setdelay')
         yield bot.update_settings(message['from']['id'], delay=int(message['text']))
+        bot.schedule_publication()
         yield bot.send_message(pgettext('Messages delay successfully changed', 'Delay value updated'),
                                reply_to_message=message)
         return True
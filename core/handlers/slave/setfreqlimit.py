@@ -2,10 +2,12 @@ from tornado.gen import coroutine
 
 from tobot import CommandFilterTextCmd
 from core.slave_command_filters import CommandFilterIsPowerfulUser
+from core.update_router import router
 from tobot.helpers import pgettext
 from tobot.telegram import ForceReply
 
 
+@router.route(command='/setfreqlimit')
 @coroutine
 @CommandFilterTextCmd('/setfreqlimit')
 @CommandFilterIsPowerfulUser()
@@ -7,6 +7,7 @@ from tornado.gen import coroutine
 from tobot import CommandFilterTextCmd, CommandFilterTextAny
 from core.settings import LANGUAGE_LIST
 from core.slave_command_filters import CommandFilterIsPowerfulUser
+from core.update_router import router
 from tobot.helpers import Emoji, pgettext
 from tobot.telegram import KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardHide
 
@@ -26,6 +27,7 @@ def get_keyboard(with_back: bool):
     return ReplyKeyboardMarkup(keyboard_rows, resize_keyboard=True, selective=True)
 
 
+@router.route(command='/setlanguage')
 @coroutine
 @CommandFilterTextCmd('/setlanguage')
 @CommandFilterIsPowerfulUser()
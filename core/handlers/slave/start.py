@@ -2,8 +2,10 @@ from tornado.gen import coroutine
 
 from tobot import CommandFilterTextCmd
 from tobot.helpers import report_botan
+from core.update_router import router
 
 
+@router.route(command='/start')
 @coroutine
 @CommandFilterTextCmd('/start')
 def start_command(bot, message):
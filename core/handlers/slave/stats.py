@@ -6,10 +6,12 @@ from tornado.gen import coroutine
 
 from tobot import CommandFilterTextCmd
 from core.slave_command_filters import CommandFilterIsModerator
+from core.update_router import router
 from tobot.helpers import pgettext, Emoji, npgettext, report_botan
 from tobot.helpers.lazy_gettext import set_locale_recursive
 
 
+@router.route(command='/stats')
 @coroutine
 @CommandFilterTextCmd('/stats')
 @CommandFilterIsModerator()
@@ -80,84 +82,61 @@ def stats_command(bot, message):
         else '%s - %s' % (format_date(period_begin.date(), locale=bot.language),
                           format_date(period_end.date(), locale=bot.language))
 
-    lines = [
-        pgettext('Stats header', 'Stats for {period}').format(period=period_str),
-        '',
-        pgettext('TOP type', 'TOP5 voters:'),
-    ]
-
+    # Daily per-user counters are kept up to date by the stats_daily_* triggers
     query = """
-        SELECT vh.user_id, u.first_name, u.last_name, count(*), SUM(vote_yes::INT) FROM votes_history vh
-        JOIN incoming_messages im ON im.id = vh.message_id AND im.original_chat_id = vh.original_chat_id
-        LEFT JOIN users u ON u.user_id = vh.user_id AND u.bot_id = im.bot_id
-        WHERE im.bot_id = %s AND vh.created_at BETWEEN %s AND %s
-        GROUP BY vh.user_id, u.first_name, u.last_name
-        ORDER BY COUNT(*) DESC
-        LIMIT 5
+        WITH s AS (
+            SELECT user_id, SUM(votes) AS votes, SUM(votes_yes) AS votes_yes, SUM(messages) AS messages,
+                   SUM(published) AS published, SUM(declined) AS declined
+            FROM stats_daily
+            WHERE bot_id = %s AND day BETWEEN %s AND %s
+            GROUP BY user_id
+        ), top AS (
+            (SELECT 0 AS top, user_id, votes AS cnt, votes_yes FROM s WHERE votes > 0 ORDER BY votes DESC LIMIT 5)
+            UNION ALL
+            (SELECT 1, user_id, messages, NULL FROM s WHERE messages > 0 ORDER BY messages DESC LIMIT 5)
+            UNION ALL
+            (SELECT 2, user_id, published, NULL FROM s WHERE published > 0 ORDER BY published DESC LIMIT 5)
+            UNION ALL
+            (SELECT 3, user_id, declined, NULL FROM s WHERE declined > 0 ORDER BY declined DESC LIMIT 5)
+        )
+        SELECT top.top, top.user_id, u.first_name, u.last_name, top.cnt, top.votes_yes FROM top
+        LEFT JOIN users u ON u.user_id = top.user_id AND u.bot_id = %s
+        ORDER BY top.top, top.cnt DESC
         """
 
-    cur = yield bot.db.execute(query, (bot.bot_id, period_begin, period_end))
-    votes_cnt=format_number(row[0], bot.language)
-    votes_yes_cnt=format_number(row[1], bot.language)
+    cur = yield bot.db.execute(query, (bot.bot_id, period_begin.date(), period_end.date(), bot.bot_id))
+    tops = [[], [], [], []]
+    for row in cur.fetchall():
+        tops[row[0]].append(row[1:])
 
     def format_top_votes(row):
+        votes_cnt, votes_yes_cnt = row[0], row[1]
         return npgettext('Votes count', '{votes_cnt} vote with {votes_yes_cnt} {thumb_up_sign} ({votes_percent}%)',
                          '{votes_cnt} votes with {votes_yes_cnt} {thumb_up_sign} ({votes_percent}%)',
-                         row[0]).format(votes_cnt,
-                                        votes_yes_cnt,
-                                        thumb_up_sign=Emoji.THUMBS_UP_SIGN,
-                                        votes_percent=100 * votes_yes_cnt // votes_cnt)
-
-    lines += format_top(cur.fetchall(), format_top_votes)
-    lines.append('')
-    lines.append(pgettext('TOP type', 'TOP5 users by messages count:'))
-
-    query = """
-        SELECT im.owner_id, u.first_name, u.last_name, count(*) FROM incoming_messages im
-        LEFT JOIN users u ON u.user_id = im.owner_id AND u.bot_id = im.bot_id
-        WHERE im.bot_id = %s AND im.created_at BETWEEN %s AND %s
-        GROUP BY im.owner_id, u.first_name, u.last_name
-        ORDER BY COUNT(*) DESC
-        LIMIT 5
-        """
-
-    cur = yield bot.db.execute(query, (bot.bot_id, period_begin, period_end))
+                         votes_cnt).format(votes_cnt=format_number(votes_cnt, bot.language),
+                                           votes_yes_cnt=format_number(votes_yes_cnt, bot.language),
+                                           thumb_up_sign=Emoji.THUMBS_UP_SIGN,
+                                           votes_percent=100 * votes_yes_cnt // votes_cnt)
 
     def format_top_messages(row):
         return npgettext('Messages count', '{messages_cnt} message', '{messages_cnt} messages', row[0]) \
             .format(messages_cnt=format_number(row[0], bot.language))
 
-    lines += format_top(cur.fetchall(), format_top_messages)
+    lines = [
+        pgettext('Stats header', 'Stats for {period}').format(period=period_str),
+        '',
+        pgettext('TOP type', 'TOP5 voters:'),
+    ]
+    lines += format_top(tops[0], format_top_votes)
+    lines.append('')
+    lines.append(pgettext('TOP type', 'TOP5 users by messages count:'))
+    lines += format_top(tops[1], format_top_messages)
     lines.append('')
     lines.append(pgettext('TOP type', 'TOP5 users by published messages count:'))
-
-    query = """
-        SELECT im.owner_id, u.first_name, u.last_name, count(*) FROM incoming_messages im
-        LEFT JOIN users u ON u.user_id = im.owner_id AND u.bot_id = im.bot_id
-        WHERE im.bot_id = %s AND im.created_at BETWEEN %s AND %s AND im.is_published = TRUE
-        GROUP BY im.owner_id, u.first_name, u.last_name
-        ORDER BY COUNT(*) DESC
-        LIMIT 5
-        """
-
-    cur = yield bot.db.execute(query, (bot.bot_id, period_begin, period_end))
-
-    lines += format_top(cur.fetchall(), format_top_messages)
+    lines += format_top(tops[2], format_top_messages)
     lines.append('')
     lines.append(pgettext('TOP type', 'TOP5 users by declined messages count:'))
-
-    query = """
-        SELECT im.owner_id, u.first_name, u.last_name, count(*) FROM incoming_messages im
-        LEFT JOIN users u ON u.user_id = im.owner_id AND u.bot_id = im.bot_id
-        WHERE im.bot_id = %s AND im.created_at BETWEEN %s AND %s AND is_voting_fail = TRUE
-        GROUP BY im.owner_id, u.first_name, u.last_name
-        ORDER BY COUNT(*) DESC
-        LIMIT 5
-        """
-
-    cur = yield bot.db.execute(query, (bot.bot_id, period_begin, period_end))
-
-    lines += format_top(cur.fetchall(), format_top_messages)
+    lines += format_top(tops[3], format_top_messages)
 
     msg = '\n'.join(set_locale_recursive(lines, bot.locale))
 
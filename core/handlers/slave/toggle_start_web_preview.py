@@ -2,9 +2,11 @@ from tornado.gen import coroutine
 
 from tobot import CommandFilterTextCmd
 from core.slave_command_filters import CommandFilterIsPowerfulUser
+from core.update_router import router
 from tobot.helpers import report_botan, pgettext
 
 
+@router.route(command='/togglestartwebpreview')
 @coroutine
 @CommandFilterTextCmd('/togglestartwebpreview')
 @CommandFilterIsPowerfulUser()
@@ -30,7 +30,14 @@ def validate_user(bot, **kwargs):
     if 'message' not in kwargs:
         return False
 
-    allowed = yield is_allowed_user(bot.db, kwargs['message']['from'], bot.bot_id)
+    user = kwargs['message']['from']
+    if getattr(bot, 'banned_users', None) is None:
+        allowed = yield is_allowed_user(bot.db, user, bot.bot_id)
+    else:
+        # Bot keeps the banned users list in memory, the profile is saved in background
+        bot.profiles.update(bot.bot_id, user)
+        allowed = user['id'] not in bot.banned_users
+
     if allowed:
         return False
 
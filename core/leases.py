@@ -0,0 +1,169 @@
+import logging
+from time import time
+
+from momoko import Connection
+from tornado.gen import coroutine, sleep
+from tornado.ioloop import IOLoop
+from tornado.locks import Lock
+
+# Bigint key of an advisory lock as represented in pg_locks
+LEASE_KEY = '((classid::BIGINT << 32) | objid::BIGINT)'
+
+
+class BotLeases:
+    """
+    Bot ownership for multi-node slave-holders. Each leased bot is a session-level advisory lock keyed by the bot id,
+    held on a dedicated connection: when the holder dies, its connection (and every lease with it) goes away and the
+    bots become available for the peers.
+    """
+
+    def __init__(self, dsn, capacity, ioloop=None):
+        self.dsn = dsn
+        self.capacity = capacity
+        self.ioloop = ioloop or IOLoop.current()
+        self.owned = set()
+        self.backend_pid = None
+        self._conn = None
+        self._lock = Lock()
+
+    @property
+    def connected(self):
+        return self._conn is not None and not self._conn.closed
+
+    @property
+    def is_full(self):
+        return len(self.owned) >= self.capacity
+
+    def owns(self, bot_id):
+        return bot_id in self.owned
+
+    @coroutine
+    def connect(self):
+        self.owned = set()
+        self._conn = yield Connection(self.dsn, ioloop=self.ioloop).connect()
+        cur = yield self._execute('SELECT pg_backend_pid()')
+        self.backend_pid = cur.fetchone()[0]
+
+    def close(self):
+        if self._conn is not None and not self._conn.closed:
+            self._conn.close()
+        self._conn = None
+        self.owned = set()
+
+    @coroutine
+    def _execute(self, query, params=()):
+        with (yield self._lock.acquire()):
+            return (yield self._conn.execute(query, params))
+
+    @coroutine
+    def acquire(self, bot_id):
+        if self.owns(bot_id):
+            return True
+
+        if self.is_full:
+            return False
+
+        cur = yield self._execute('SELECT pg_try_advisory_lock(%s::BIGINT)', (bot_id,))
+        if cur.fetchone()[0]:
+            logging.debug('[bot#%s] Lease acquired', bot_id)
+            self.owned.add(bot_id)
+            return True
+
+        return False
+
+    @coroutine
+    def take_over(self, bot_id, timeout):
+        """
+        Waits up to `timeout` seconds for the lease handed off by its owner. Postgres grants a released lock to the
+        waiting session, so the peers trying to claim the bot meanwhile don't get it. The wait is done on a separate
+        connection, the lease connection is only busy while the lock is passed over to it.
+        """
+        if self.owns(bot_id):
+            return True
+
+        if self.is_full:
+            return False
+
+        waiter = None
+        try:
+            waiter = yield Connection(self.dsn, ioloop=self.ioloop).connect()
+            yield waiter.execute('SET lock_timeout = %s', ('%dms' % (timeout * 1000),))
+            yield waiter.execute('SELECT pg_advisory_lock(%s::BIGINT)', (bot_id,))
+        except Exception as e:
+            logging.debug('[bot#%s] Lease was not handed off: %s', bot_id, e)
+            if waiter is not None and not waiter.closed:
+                waiter.close()
+            return False
+
+        # The lease connection queues for the lock before the waiter lets it go; closing the waiter releases the lock
+        # in any case
+        locked = self._execute('SELECT pg_advisory_lock(%s::BIGINT)', (bot_id,))
+        try:
+            while not locked.done():
+                cur = yield waiter.execute("SELECT EXISTS(SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND "
+                                           "objsubid = 1 AND NOT granted AND pid = %s AND " + LEASE_KEY + " = %s)",
+                                           (self.backend_pid, bot_id))
+                if cur.fetchone()[0]:
+                    break
+                yield sleep(0.01)
+
+            yield waiter.execute('SELECT pg_advisory_unlock(%s::BIGINT)', (bot_id,))
+        except Exception:
+            logging.exception('[bot#%s] Unable to pass the lease over', bot_id)
+        finally:
+            if not waiter.closed:
+                waiter.close()
+
+        try:
+            yield locked
+        except Exception as e:
+            logging.debug('[bot#%s] Lease was not taken over: %s', bot_id, e)
+            return False
+
+        logging.debug('[bot#%s] Lease taken over', bot_id)
+        self.owned.add(bot_id)
+        return True
+
+    @coroutine
+    def wait_for_successor(self, bot_id, timeout):
+        """
+        Waits up to `timeout` seconds until another holder waits for the lease in take_over().
+        """
+        deadline = time() + timeout
+        while time() < deadline:
+            cur = yield self._execute("SELECT EXISTS(SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND "
+                                      "objsubid = 1 AND NOT granted AND " + LEASE_KEY + " = %s)", (bot_id,))
+            if cur.fetchone()[0]:
+                return True
+            yield sleep(0.1)
+
+        return False
+
+    @coroutine
+    def release(self, bot_id):
+        if not self.owns(bot_id):
+            return
+
+        self.owned.discard(bot_id)
+        if self.connected:
+            yield self._execute('SELECT pg_advisory_unlock(%s::BIGINT)', (bot_id,))
+            logging.debug('[bot#%s] Lease released', bot_id)
+
+    @coroutine
+    def is_leased(self, bot_id):
+        if self.owns(bot_id):
+            return True
+
+        cur = yield self._execute("SELECT EXISTS(SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND "
+                                  "objsubid = 1 AND " + LEASE_KEY + " = %s)", (bot_id,))
+        return cur.fetchone()[0]
+
+    @coroutine
+    def heartbeat(self):
+        try:
+            yield self._execute('SELECT 1')
+            return True
+        except Exception:
+            logging.exception('Leases connection lost, %d leases are gone', len(self.owned))
+            self.close()
+            return False
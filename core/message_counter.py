@@ -0,0 +1,65 @@
+from collections import deque
+from time import time
+
+from tornado.gen import coroutine
+
+from .cache import LRUCache
+
+
+class MessageCounter:
+    """
+    Sliding-window counter of the messages a bot's users sent for moderation, backing the `msg_freq_limit` check.
+    A user's recent messages are read from the DB the first time the user is seen, afterwards the counter is updated in
+    memory on every new message. Only the last `limit` timestamps are kept per user, the least active users are evicted
+    once `capacity` of them are tracked.
+    """
+
+    def __init__(self, db, bot_id, capacity=10000):
+        self.db = db
+        self.bot_id = bot_id
+        self._users = LRUCache(capacity)
+        self._seeding = {}
+
+    @coroutine
+    def count(self, user_id, limit, days):
+        """
+        Returns the number of messages sent by the user during the last `days` days, capped at `limit`.
+        """
+        entry = self._users.get(user_id)
+        if entry is None or entry[0] != (limit, days):
+            entry = yield self._seed(user_id, limit, days)
+
+        timestamps = entry[1]
+        expire_before = time() - days * 86400
+        while timestamps and timestamps[0] < expire_before:
+            timestamps.popleft()
+
+        return len(timestamps)
+
+    def add(self, user_id):
+        entry = self._users.get(user_id)
+        if entry is not None:
+            entry[1].append(time())
+        elif user_id in self._seeding:
+            # The message may be missed by the query in flight, the result is not cached then
+            self._seeding[user_id] = True
+
+    @coroutine
+    def _seed(self, user_id, limit, days):
+        self._seeding.setdefault(user_id, False)
+        try:
+            cur = yield self.db.execute("""
+                SELECT EXTRACT(EPOCH FROM NOW() - created_at) FROM incoming_messages
+                WHERE bot_id = %s AND owner_id = %s AND created_at >= NOW() - %s * INTERVAL '1 day'
+                ORDER BY created_at DESC
+                LIMIT %s
+            """, (self.bot_id, user_id, days, limit))
+        finally:
+            changed = self._seeding.pop(user_id, True)
+
+        now = time()
+        entry = ((limit, days), deque(sorted(now - age for age, in cur.fetchall()), maxlen=limit))
+        if not changed:
+            self._users.set(user_id, entry)
+
+        return entry
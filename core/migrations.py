@@ -0,0 +1,116 @@
+import logging
+import os
+import re
+from functools import partial
+
+from momoko import Connection
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+# Serializes the runners of the servers starting at the same time. Two-int key, so it's never taken for a bot lease:
+# those are single bigint keys (objsubid = 1 in pg_locks)
+MIGRATIONS_LOCK = (0x626f7465, 1)
+# Statement following this comment is executed again while it returns a positive number, e.g. a batched backfill
+REPEAT_DIRECTIVE = '-- migrate: repeat'
+# Migration starting with this comment is never applied on startup, e.g. it locks the busy tables for too long
+MANUAL_DIRECTIVE = '-- migrate: manual'
+
+_COMMENT_RE = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_TOKEN_RE = re.compile(_COMMENT_RE.pattern + r"""|'(?:[^']|'')*'|"(?:[^"]|"")*"|(\$[A-Za-z_0-9]*\$).*?\1|;""", re.S)
+
+
+class MigrationError(Exception):
+    pass
+
+
+def split_statements(sql):
+    """
+    Splits an SQL script into statements, so every one of them runs in its own transaction: CREATE INDEX CONCURRENTLY
+    can't be executed within a multi-statement query.
+    """
+    statements = []
+    start = 0
+    for match in _TOKEN_RE.finditer(sql):
+        if match.group(0) == ';':
+            statements.append(sql[start:match.end()].strip())
+            start = match.end()
+
+    if sql[start:].strip():
+        statements.append(sql[start:].strip())
+
+    return [statement for statement in statements if _COMMENT_RE.sub('', statement).strip().strip(';')]
+
+
+def list_migrations(path=MIGRATIONS_DIR):
+    return sorted(os.path.splitext(name)[0] for name in os.listdir(path) if name.endswith('.sql'))
+
+
+def _escape(statement):
+    # Parameters are always passed, so psycopg2 expects percent signs (e.g. in %ROWTYPE) to be escaped
+    return statement.replace('%', '%%')
+
+
+@coroutine
+def _execute_repeated(conn, statement):
+    total = 0
+    while True:
+        cur = yield conn.execute(_escape(statement), ())
+        done = cur.fetchone()[0]
+        if not done:
+            return total
+        total += done
+
+
+@coroutine
+def migrate(dsn, path=MIGRATIONS_DIR, ioloop=None):
+    """
+    Applies migrations from `path` missing in the schema_migrations table, in the file names order. Every statement is
+    executed in its own transaction unless the migration opens one itself. Stops with MigrationError at a manual
+    migration, which records itself in schema_migrations once applied by hand.
+    """
+    conn = yield Connection(dsn, ioloop=ioloop or IOLoop.current()).connect()
+    try:
+        yield conn.execute('SELECT pg_advisory_lock(%s, %s)', MIGRATIONS_LOCK)
+
+        # Databases created before the versions were tracked get every migration, they are safe to apply again
+        yield conn.execute('CREATE TABLE IF NOT EXISTS schema_migrations (version character varying NOT NULL '
+                           'PRIMARY KEY, applied_at timestamp without time zone DEFAULT now() NOT NULL)')
+
+        cur = yield conn.execute('SELECT version FROM schema_migrations')
+        applied = {row[0] for row in cur.fetchall()}
+
+        for version in list_migrations(path):
+            if version in applied:
+                continue
+
+            with open(os.path.join(path, version + '.sql')) as f:
+                sql = f.read()
+
+            if sql.startswith(MANUAL_DIRECTIVE):
+                raise MigrationError('Migration %s has to be applied by hand, see readme.md' % version)
+
+            logging.info('Applying migration %s', version)
+            statements = split_statements(sql)
+
+            for statement in statements:
+                if statement.startswith(REPEAT_DIRECTIVE):
+                    rows = yield _execute_repeated(conn, statement)
+                    logging.info('[%s] %d rows processed', version, rows)
+                else:
+                    yield conn.execute(_escape(statement), ())
+
+            yield conn.execute('INSERT INTO schema_migrations (version) VALUES (%s)', (version,))
+    finally:
+        conn.close()
+
+
+def apply_migrations(dsn):
+    """
+    Runs migrate() on its own IOLoop, so the servers can call it before forking their workers.
+    """
+    ioloop = IOLoop(make_current=False)
+    try:
+        ioloop.run_sync(partial(migrate, dsn, ioloop=ioloop))
+    finally:
+        ioloop.close()
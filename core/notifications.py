@@ -0,0 +1,61 @@
+import logging
+
+from momoko import Connection
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+# Payload is "<bot_id>:<user_id>:<1 if banned else 0>"
+USER_BANS_CHANNEL = 'user_bans'
+
+
+class PgListener:
+    """
+    LISTEN for Postgres notifications on a dedicated connection. Channels have to be registered before connect():
+    once connected the connection socket is watched by the listener itself and can't run queries anymore.
+    """
+
+    def __init__(self, dsn, ioloop=None):
+        self.dsn = dsn
+        self.ioloop = ioloop or IOLoop.current()
+        self._conn = None
+        self._callbacks = {}
+
+    @property
+    def connected(self):
+        return self._conn is not None and not self._conn.closed
+
+    def listen(self, channel, callback):
+        assert self._conn is None, 'Channels have to be registered before connecting'
+        self._callbacks[channel] = callback
+
+    @coroutine
+    def connect(self):
+        conn = yield Connection(self.dsn, ioloop=self.ioloop).connect()
+        for channel in self._callbacks:
+            yield conn.execute('LISTEN ' + channel)
+
+        self._conn = conn
+        self.ioloop.add_handler(conn.fileno, self._on_readable, IOLoop.READ)
+
+    def close(self):
+        if self._conn is not None:
+            self.ioloop.remove_handler(self._conn.fileno)
+            if not self._conn.closed:
+                self._conn.close()
+        self._conn = None
+
+    def _on_readable(self, fd, events):
+        connection = self._conn.connection
+        try:
+            connection.poll()
+        except Exception:
+            logging.exception('Notifications connection lost')
+            self.close()
+            return
+
+        while connection.notifies:
+            notify = connection.notifies.pop(0)
+            try:
+                self._callbacks[notify.channel](notify.payload)
+            except Exception:
+                logging.exception('Unable to handle notification %s: %s', notify.channel, notify.payload)
@@ -20,6 +20,10 @@ def slaveholder_queues():
             if queue_variable.startswith('QUEUE_SLAVEHOLDER_')]
 
 
+def holder_queue(queue_name, holder_id):
+    return '%s_%s' % (queue_name, holder_id)
+
+
 @coroutine
 def queue_request(queue, queue_name, **kwargs):
     def queue_listener(queue_name, body):
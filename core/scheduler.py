@@ -0,0 +1,131 @@
+import heapq
+import logging
+from itertools import count
+from time import time
+
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+
+
+class _Job:
+    __slots__ = ('key', 'callback', 'interval', 'due', 'running')
+
+    def __init__(self, key, callback, interval, due):
+        self.key = key
+        self.callback = callback
+        self.interval = interval
+        self.due = due
+        self.running = False
+
+    def next_interval(self):
+        return self.interval() if callable(self.interval) else self.interval
+
+
+class JobScheduler:
+    """
+    Periodic jobs of many bots on a single timer: one heap instead of an add_timeout chain per bot. Jobs are keyed, so
+    adding the same job again just replaces it; first runs are spread over the interval, so bots started at the same
+    time don't query the DB all together. Next run is scheduled once the previous one is finished.
+    """
+
+    def __init__(self, concurrency=50):
+        self._jobs = {}
+        self._heap = []
+        self._seq = count()
+        self._timeout = None
+        self._timeout_at = None
+        self._slots = Semaphore(concurrency)
+        self.stats = {}
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def reset_stats(self):
+        self.stats = {
+            'runs': 0,
+            'failures': 0,
+            'skipped': 0,
+            'lag_total': 0.0,
+            'lag_max': 0.0,
+        }
+
+    def lag_stats(self):
+        runs = self.stats['runs']
+        return {
+            'jobs': len(self._jobs),
+            'runs': runs,
+            'failures': self.stats['failures'],
+            'skipped': self.stats['skipped'],
+            'lag_avg': self.stats['lag_total'] / runs if runs else 0.0,
+            'lag_max': self.stats['lag_max'],
+        }
+
+    def add(self, key, callback, interval, spread=True):
+        """
+        `callback` is a coroutine function, `interval` is either number of seconds or a function returning it.
+        """
+        job = _Job(key, callback, interval, time())
+        if spread:
+            job.due += job.next_interval() * (hash(key) % 1000) / 1000
+        self._jobs[key] = job
+        self._push(job)
+
+    def remove(self, key):
+        self._jobs.pop(key, None)
+        if not self._jobs and self._timeout:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = self._timeout_at = None
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (job.due, next(self._seq), job))
+        if self._timeout_at is None or job.due < self._timeout_at:
+            if self._timeout:
+                IOLoop.current().remove_timeout(self._timeout)
+            self._timeout_at = job.due
+            self._timeout = IOLoop.current().call_at(IOLoop.current().time() + max(job.due - time(), 0), self._tick)
+
+    def _tick(self):
+        self._timeout = self._timeout_at = None
+        now = time()
+        while self._heap and self._heap[0][0] <= now:
+            due, _, job = heapq.heappop(self._heap)
+            # Removed, replaced or already rescheduled job
+            if self._jobs.get(job.key) is not job or job.due != due:
+                continue
+
+            if job.running:
+                self.stats['skipped'] += 1
+                continue
+
+            job.running = True
+            IOLoop.current().add_callback(self._run, job)
+
+        # Drop stale entries from the top so they don't cause empty wakeups
+        while self._heap and self._jobs.get(self._heap[0][2].key) is not self._heap[0][2]:
+            heapq.heappop(self._heap)
+
+        if self._heap:
+            due = self._heap[0][0]
+            self._timeout_at = due
+            self._timeout = IOLoop.current().call_at(IOLoop.current().time() + max(due - now, 0), self._tick)
+
+    @coroutine
+    def _run(self, job):
+        try:
+            with (yield self._slots.acquire()):
+                lag = max(time() - job.due, 0)
+                self.stats['runs'] += 1
+                self.stats['lag_total'] += lag
+                self.stats['lag_max'] = max(self.stats['lag_max'], lag)
+                try:
+                    yield job.callback()
+                except Exception:
+                    self.stats['failures'] += 1
+                    logging.exception('Scheduled job %s failed', job.key)
+        finally:
+            job.running = False
+            if self._jobs.get(job.key) is job:
+                job.due = time() + job.next_interval()
+                self._push(job)
@@ -1,13 +1,18 @@
+import hashlib
+import json
 import logging
 from datetime import datetime, timedelta
+from functools import partial
+from time import time
 
-from tornado.gen import coroutine
+from tornado.concurrent import Future
+from tornado.gen import coroutine, sleep, WaitIterator
 from tornado.ioloop import IOLoop
+from tornado.locks import Event, Lock
 from tornado import locale
 from ujson import dumps
 
 from tobot import Base
-from tobot.stages import PersistentStages
 from core.handlers.cancel import cancel_command
 from core.handlers.emoji_end import emoji_end
 from core.handlers.slave.ban import ban_command, plaintext_ban_handler, unban_command, ban_list_command
@@ -43,21 +48,77 @@ from core.handlers.slave.vote import vote_new, vote_old
 from core.handlers.unknown_command import unknown_command
 from core.handlers.validate_user import validate_user
 from core.settings import DEFAULT_SLAVE_SETTINGS
+from core.cache import LRUCache
+from core.message_counter import MessageCounter
+from core.notifications import USER_BANS_CHANNEL
+from core.scheduler import JobScheduler
+from core.stages import StagesStore
+from core.user_profiles import UserProfiles
+from core.bot_api import call_api, BotApiError, ALLOWED_UPDATES
+from core.webhook import set_webhook
 from tobot.helpers import report_botan, npgettext, pgettext, Emoji
 from tobot.helpers.lazy_gettext import set_locale_recursive
 from tobot.telegram import InlineKeyboardMarkup, InlineKeyboardButton, ApiError
 
 
 class Slave(Base):
+    UPDATES_POLL_TIMEOUT = 30
+    # Publication is triggered by votes, periodic check only catches what was missed (e.g. settings changed elsewhere)
+    PUBLICATION_CHECK_INTERVAL = 600
+    PUBLICATION_RETRY_INTERVAL = 60
+    # Open polls state; entries are re-read from the DB after the TTL in case the poll was changed by another process,
+    # and the whole cache is dropped every time the bot is started, i.e. the lease is acquired
+    POLLS_CACHE_SIZE = 1000
+    POLLS_CACHE_TTL = 60
+    POLL_FIELDS = ('owner_id', 'yes_count', 'no_count', 'is_published', 'is_voting_success', 'is_voting_fail',
+                   'moderation_message_id', 'moderation_fwd_message_id')
+    # Telegram allows about 20 messages per minute in a group, edits are throttled the same way: a few go out at
+    # once, the rest are spread to keep within the limit
+    MODERATION_CHAT_EDITS_BURST = 5
+    MODERATION_CHAT_EDITS_PER_SECOND = 20 / 60
+    # Open polls are looked up since the oldest of them minus this margin, so only the recent partitions are scanned
+    POLLS_SINCE_MARGIN = timedelta(hours=1)
+
     def __init__(self, token, db, **kwargs):
         bot_settings = kwargs.pop('settings', {})
         if 'hello' in bot_settings:
             del bot_settings['hello']
         bot_settings = self.merge_settings_recursive(DEFAULT_SLAVE_SETTINGS, bot_settings)
         self.db = db
-        super().__init__(token, stages_builder=lambda bot_id: PersistentStages(bot_id, db), settings=bot_settings,
+        moderator_chat_type = kwargs.pop('moderator_chat_type', None)
+        moderator_chat_admins = kwargs.pop('moderator_chat_admins', None)
+        kwargs.pop('moderator_chat_updated_at', None)
+        self.webhook_url = kwargs.pop('webhook_url', None)
+        self.hibernate_after = kwargs.pop('hibernate_after', 0)
+        self.hibernation_poll_interval = kwargs.pop('hibernation_poll_interval', 60)
+        self.edit_window = kwargs.pop('edit_window', 0.5)
+        self.early_callback_answer = kwargs.pop('early_callback_answer', True)
+        self.scheduler = kwargs.pop('scheduler', None) or JobScheduler()
+        self.profiles = kwargs.pop('profiles', None) or UserProfiles(db)
+        self.stages_store = kwargs.pop('stages_store', None) or StagesStore(db)
+        self.token = token
+        super().__init__(token, stages_builder=self.stages_store.stages, settings=bot_settings,
                          ignore_403_in_handlers=True, **kwargs)
-        self.administrators = [kwargs['owner_id']]
+        self.moderator_chat_type = moderator_chat_type
+        self.administrators = moderator_chat_admins or [kwargs['owner_id']]
+        self._moderator_chat_cached = bool(moderator_chat_admins)
+        self._fatal_error = None
+        self.last_update_id = None
+        self.updates_count = 0
+        self._poll_interrupt = None
+        self.serving = Event()
+        self.hibernating = False
+        self._last_update_at = time()
+        self._publication_lock = Lock()
+        self._publication_timeout = None
+        self.polls = LRUCache(self.POLLS_CACHE_SIZE, self.POLLS_CACHE_TTL)
+        self._pending_votes = {}
+        self._pending_edits = {}
+        self._edit_fingerprints = LRUCache(self.POLLS_CACHE_SIZE)
+        self._chat_edit_buckets = {}
+        self.banned_users = None
+        self.polls_since = None
+        self.messages_counter = MessageCounter(db, kwargs['id'])
 
     @coroutine
     def _update_settings_for_bot(self, settings):
@@ -144,50 +205,256 @@ class Slave(Base):
         self._add_handler(migrate_to_supergroup_msg)
 
     @coroutine
-    def start(self):
-        self.check_votes_success()
-        self.check_votes_failures()
+    def start(self, last_update_id=None):
+        self._finished.clear()
+        self.last_update_id = last_update_id
+        # Another holder could have served the bot meanwhile
+        self.polls.clear()
+        self._edit_fingerprints.clear()
+        try:
+            yield self.load_banned_users()
+            yield self.refresh_polls_since()
+            self.schedule_publication()
+            self.scheduler.add(('check_votes_success', self.bot_id), self.check_votes_success,
+                               self.PUBLICATION_CHECK_INTERVAL)
+            if self._moderator_chat_cached:
+                IOLoop.current().add_future(self.refresh_moderator_chat(), self._moderator_chat_refreshed)
+            else:
+                yield self.refresh_moderator_chat()
+
+            if self.webhook_url:
+                yield set_webhook(self.token, self.webhook_url)
+                self.serving.set()
+                yield self._finished.wait()
+            else:
+                self.serving.set()
+                yield self._poll_updates()
+
+            if self._fatal_error:
+                raise self._fatal_error
+        finally:
+            self.scheduler.remove(('check_votes_success', self.bot_id))
+            self._cancel_publication()
+            self.serving.clear()
+            self._finished.set()
+            yield self.profiles.flush()
+            yield self.stages_store.flush()
+
+    @coroutine
+    def load_banned_users(self):
+        cur = yield self.db.execute('SELECT user_id FROM users WHERE bot_id = %s AND banned_at IS NOT NULL',
+                                    (self.bot_id,))
+        self.banned_users = {row[0] for row in cur.fetchall()}
+
+    @coroutine
+    def refresh_polls_since(self):
+        # Polls only get closed and the new ones are newer, so the scan starts from the previous value; the first one
+        # goes through all the partitions, however old the oldest open poll is
+        cur = yield self.db.execute('SELECT COALESCE(MIN(created_at), LOCALTIMESTAMP) FROM incoming_messages '
+                                    'WHERE bot_id = %s AND is_published = FALSE AND is_voting_fail = FALSE '
+                                    'AND created_at >= %s', (self.bot_id, self.polls_since or datetime.min))
+        self.polls_since = cur.fetchone()[0] - self.POLLS_SINCE_MARGIN
+
+    def set_user_banned(self, user_id, banned):
+        if self.banned_users is None:
+            return
+
+        if banned:
+            self.banned_users.add(int(user_id))
+        else:
+            self.banned_users.discard(int(user_id))
+
+    @coroutine
+    def update_user_ban(self, user_id, banned, reason=None):
+        """
+        Returns False when there's no row for the user, e.g. the profile wasn't saved yet because of a failed flush.
+        """
+        # The profile could be still waiting in the write-behind buffer
+        yield self.profiles.flush()
+        # Other processes serving the bot (e.g. during a handoff) are notified by the same statement
+        cur = yield self.db.execute('WITH updated AS (UPDATE users SET banned_at = CASE WHEN %s THEN NOW() END, '
+                                    'ban_reason = %s WHERE user_id = %s AND bot_id = %s RETURNING user_id) '
+                                    'SELECT pg_notify(%s, %s) FROM updated',
+                                    (banned, reason, user_id, self.bot_id, USER_BANS_CHANNEL,
+                                     '%s:%s:%d' % (self.bot_id, user_id, banned)))
+        if not cur.rowcount:
+            return False
+
+        self.set_user_banned(user_id, banned)
+        return True
+
+    @coroutine
+    def refresh_moderator_chat(self):
         chat_info = yield self.api.get_chat(self.moderator_chat_id)
         if chat_info['type'] == 'private':
-            self.administrators = [chat_info['id']]
+            administrators = [chat_info['id']]
         else:
             admins = yield self.api.get_chat_administrators(self.moderator_chat_id)
-            self.administrators = [
+            administrators = [
                 user['user']['id']
                 for user in admins
                 ]
-        yield super().start()
+
+        self.moderator_chat_type = chat_info['type']
+        self.administrators = administrators
+        yield self.db.execute('UPDATE registered_bots SET moderator_chat_type = %s, moderator_chat_admins = %s, '
+                              'moderator_chat_updated_at = NOW() WHERE id = %s',
+                              (chat_info['type'], administrators, self.bot_id))
+
+    def _moderator_chat_refreshed(self, f):
+        e = f.exception()
+        if isinstance(e, ApiError):
+            # Telegram rejected the chat, stop the same way as failing on the startup does
+            self._fatal_error = e
+            self.stop()
+        elif e:
+            logging.warning('[bot #%d] Unable to refresh moderators chat info, keeping the cached one: %s',
+                            self.bot_id, e)
 
     @coroutine
-    def check_votes_success(self):
-        cur = yield self.db.execute('SELECT last_channel_message_at FROM registered_bots WHERE id = %s',
-                                    (self.bot_id,))
+    def _poll_updates(self):
+        self._last_update_at = time()
+        while not self._finished.is_set():
+            offset = self.last_update_id + 1 if self.last_update_id is not None else None
+
+            hibernating = bool(self.hibernate_after) and time() - self._last_update_at >= self.hibernate_after
+            if hibernating != self.hibernating:
+                logging.debug('[bot #%d] %s', self.bot_id, 'Hibernating' if hibernating else 'Woke up')
+                self.hibernating = hibernating
+
+            if hibernating:
+                updates = yield self._poll_updates_once(offset)
+                if updates is None:
+                    break
+            else:
+                updates_f = self.api.get_updates(offset, timeout=self.UPDATES_POLL_TIMEOUT,
+                                                 retry_on_nonuser_error=True)
+                completed = yield self._interruptible(updates_f)
+                if not completed:
+                    # Stopped while waiting: whatever this request returns stays unconfirmed for the next poller
+                    updates_f.add_done_callback(lambda f: f.exception())
+                    break
 
-        delay = self.settings.get('delay', 15)
+                updates = updates_f.result()
 
-        row = cur.fetchone()
-        if row and row[0]:
-            allowed_time = row[0] + timedelta(minutes=delay)
-        else:
-            allowed_time = datetime.now()
+            if updates:
+                self._last_update_at = time()
+
+            for update in updates:
+                if self._finished.is_set():
+                    break
+
+                yield self._handle_update(update)
+
+    @coroutine
+    def _poll_updates_once(self, offset):
+        # Idle bot: no connection between polls, just a short request from time to time
+        completed = yield self._interruptible(sleep(self.hibernation_poll_interval))
+        if not completed:
+            return None
+
+        params = {'timeout': 0, 'allowed_updates': ALLOWED_UPDATES}
+        if offset is not None:
+            params['offset'] = offset
+
+        try:
+            return (yield call_api(self.token, 'getUpdates', **params))
+        except BotApiError as e:
+            if e.code == 429:
+                retry_after = e.parameters.get('retry_after', self.hibernation_poll_interval)
+                logging.warning('[bot #%d] Too many requests, retrying in %ss', self.bot_id, retry_after)
+                completed = yield self._interruptible(sleep(retry_after))
+                return [] if completed else None
+            elif e.code < 500:
+                raise
 
-        if datetime.now() >= allowed_time:
+            logging.warning('[bot #%d] Unable to receive updates: %s', self.bot_id, e)
+            return []
+
+    @coroutine
+    def _interruptible(self, f):
+        self._poll_interrupt = Future()
+        wait = WaitIterator(f, self._poll_interrupt)
+        yield wait.next()
+        return wait.current_future is f
+
+    @coroutine
+    def process_webhook_update(self, update):
+        # Telegram re-sends an update if it didn't receive our response
+        if self.last_update_id is not None and update['update_id'] <= self.last_update_id:
+            return
+
+        yield self._handle_update(update)
+
+    @coroutine
+    def _handle_update(self, update):
+        try:
+            yield self._process_update(update)
+        except:
+            logging.exception('[bot #%d] Got exception while processing update', self.bot_id)
+
+        self.last_update_id = update['update_id']
+        self.updates_count += 1
+
+    def stop(self):
+        super().stop()
+        if self._poll_interrupt and not self._poll_interrupt.done():
+            self._poll_interrupt.set_result(None)
+
+    @coroutine
+    def confirm_updates(self):
+        # Telegram treats every update below the requested offset as processed, webhook updates are confirmed by
+        # the response
+        if self.last_update_id is not None and not self.webhook_url:
+            yield self.api.get_updates(self.last_update_id + 1, timeout=0, retry_on_nonuser_error=True)
+
+    def schedule_publication(self, seconds=0):
+        self._cancel_publication()
+        if not self._finished.is_set():
+            self._publication_timeout = IOLoop.current().call_later(seconds, self.check_votes_success)
+
+    def _cancel_publication(self):
+        if self._publication_timeout:
+            IOLoop.current().remove_timeout(self._publication_timeout)
+            self._publication_timeout = None
+
+    @coroutine
+    def check_votes_success(self):
+        with (yield self._publication_lock.acquire()):
+            self._cancel_publication()
+            yield self.refresh_polls_since()
             cur = yield self.db.execute(
-                'SELECT message, moderation_message_id FROM incoming_messages WHERE bot_id = %s '
-                'AND is_voting_success = TRUE AND is_published = FALSE '
-                'ORDER BY created_at LIMIT 1', (self.bot_id,))
+                'SELECT message, moderation_message_id, created_at FROM incoming_messages WHERE bot_id = %s '
+                'AND is_voting_success = TRUE AND is_published = FALSE AND created_at >= %s '
+                'ORDER BY created_at LIMIT 1', (self.bot_id, self.polls_since))
+
+            message = cur.fetchone()
+            if not message:
+                # Nothing to do until the next successful voting, which schedules the publication by itself
+                return
+
+            cur = yield self.db.execute('SELECT last_channel_message_at FROM registered_bots WHERE id = %s',
+                                        (self.bot_id,))
+
+            delay = self.settings.get('delay', 15)
 
             row = cur.fetchone()
+            if row and row[0]:
+                allowed_time = row[0] + timedelta(minutes=delay)
+            else:
+                allowed_time = datetime.now()
 
-            if row:
-                yield self.publish_message(row[0], row[1])
+            wait = (allowed_time - datetime.now()).total_seconds()
+            if wait > 0:
+                self.schedule_publication(wait)
+                return
 
-        if not self._finished.is_set():
-            IOLoop.current().add_timeout(timedelta(minutes=1 if delay > 0 else 0, seconds=5 if delay == 0 else 0),
-                                         self.check_votes_success)
+            published = yield self.publish_message(message[0], message[1], message[2])
+            # There could be more messages in the queue
+            self.schedule_publication(delay * 60 if published else self.PUBLICATION_RETRY_INTERVAL)
 
     @coroutine
-    def publish_message(self, message, moderation_message_id):
+    def publish_message(self, message, moderation_message_id, created_at):
         report_botan(message, 'slave_publish')
         try:
             conn = yield self.db.getconn()
@@ -195,12 +462,12 @@ class Slave(Base):
                 try:
                     yield conn.execute('BEGIN')
                     cur = yield conn.execute(
-                        'UPDATE incoming_messages SET is_published = TRUE WHERE id = %s AND original_chat_id = %s AND '
-                        'is_published = FALSE',
-                        (message['message_id'], message['chat']['id']))
+                        'UPDATE incoming_messages SET is_published = TRUE WHERE bot_id = %s AND original_chat_id = %s '
+                        'AND id = %s AND created_at = %s AND is_published = FALSE',
+                        (self.bot_id, message['chat']['id'], message['message_id'], created_at))
                     if cur.rowcount == 0:
                         yield conn.execute('ROLLBACK')
-                        return
+                        return True
                     yield conn.execute('UPDATE registered_bots SET last_channel_message_at = NOW() WHERE id = %s',
                                        (self.bot_id,))
 
@@ -210,39 +477,30 @@ class Slave(Base):
                     yield conn.execute('ROLLBACK')
                     raise
 
+            self.update_poll(message['message_id'], message['chat']['id'], is_published=True)
+
             msg, keyboard = yield self.get_verification_message(message['message_id'], message['chat']['id'], True)
-            yield self.edit_message_text(msg, chat_id=self.moderator_chat_id, message_id=moderation_message_id,
-                                         reply_markup=keyboard)
+            yield self.edit_moderation_message(msg, self.moderator_chat_id, moderation_message_id,
+                                               reply_markup=keyboard)
+            self.forget_poll(message['message_id'], message['chat']['id'])
+            return True
         except:
             logging.exception('[bot #%d] Message forwarding failed (#%s from %s)', self.bot_id, message['message_id'], message['chat']['id'])
 
     @coroutine
-    def check_votes_failures(self):
-        vote_timeout = datetime.now() - timedelta(hours=self.settings.get('vote_timeout', 24))
-        cur = yield self.db.execute('SELECT message,'
-                                    '(SELECT SUM(vote_yes::INT) FROM votes_history vh WHERE vh.message_id = im.id '
-                                    '                               AND vh.original_chat_id = im.original_chat_id)'
-                                    'FROM incoming_messages im WHERE bot_id = %s AND '
-                                    'is_voting_success = FALSE AND is_voting_fail = FALSE AND created_at <= %s',
-                                    (self.bot_id, vote_timeout))
-
-        for message, yes_votes in cur.fetchall():
-            if yes_votes is None:
-                yes_votes = 0
-            report_botan(message, 'slave_verification_failed')
-            try:
-                yield self.decline_message(message, yes_votes)
-            except:
-                logging.exception('[bot #%d] Got exception while declining message', self.bot_id)
-
-        if not self._finished.is_set():
-            IOLoop.current().add_timeout(timedelta(minutes=10), self.check_votes_failures)
+    def decline_expired_message(self, message, yes_votes):
+        # Expired pollings are found by SlaveHolder for all the bots at once
+        report_botan(message, 'slave_verification_failed')
+        try:
+            yield self.decline_message(message, yes_votes)
+        except:
+            logging.exception('[bot #%d] Got exception while declining message', self.bot_id)
 
     @coroutine
     def decline_message(self, message, yes_votes, notify=True):
         cur = yield self.db.execute('SELECT moderation_message_id FROM incoming_messages WHERE bot_id = %s AND '
-                                    'original_chat_id = %s AND id = %s', (self.bot_id, message['chat']['id'],
-                                                                          message['message_id']))
+                                    'original_chat_id = %s AND id = %s AND created_at >= %s',
+                                    (self.bot_id, message['chat']['id'], message['message_id'], self.polls_since))
 
         row = cur.fetchone()
 
@@ -250,21 +508,17 @@ class Slave(Base):
             moderation_message_id = row[0]
 
             msg, keyboard = yield self.get_verification_message(message['message_id'], message['chat']['id'], True)
-            try:
-                yield self.edit_message_text(msg, chat_id=self.moderator_chat_id, message_id=moderation_message_id,
-                                             reply_markup=keyboard)
-            except ApiError as e:
-                # Ignore few errors while declining errors
-                if e.code != 400 or ('message is not modified' not in e.description
-                                     and 'message not found' not in e.description
-                                     and 'message to edit not found' not in e.description
-                                     and 'bot was blocked by the user' not in e.description):
-                    raise
+            # Not waited for: edits are rate limited per chat, and the sweeper and the ban handler decline in bulk
+            edit = self.edit_moderation_message(msg, self.moderator_chat_id, moderation_message_id,
+                                                reply_markup=keyboard)
+            IOLoop.current().add_future(edit, partial(self._declined_message_edited, message['message_id'],
+                                                      message['chat']['id']))
 
         yield self.db.execute('UPDATE incoming_messages SET is_voting_fail = TRUE WHERE bot_id = %s AND '
                               'is_voting_success = FALSE AND is_voting_fail = FALSE AND original_chat_id = %s '
-                              'AND id = %s',
-                              (self.bot_id, message['chat']['id'], message['message_id']))
+                              'AND id = %s AND created_at >= %s',
+                              (self.bot_id, message['chat']['id'], message['message_id'], self.polls_since))
+        self.forget_poll(message['message_id'], message['chat']['id'])
 
         if notify:
             try:
@@ -275,6 +529,15 @@ class Slave(Base):
                 if e.code != 403 or ('bot was blocked by the user' not in e.description):
                     raise
 
+    def _declined_message_edited(self, message_id, chat_id, f):
+        e = f.exception()
+        # Ignore few errors while declining messages
+        if e and (not isinstance(e, ApiError) or e.code != 400
+                  or ('message not found' not in e.description and 'message to edit not found' not in e.description
+                      and 'bot was blocked by the user' not in e.description)):
+            logging.error('[bot #%d] Unable to update declined poll message (#%s from %s)', self.bot_id, message_id,
+                          chat_id, exc_info=f.exc_info())
+
     @property
     def language(self):
         return self.settings.get('locale', 'en_US')
@@ -298,36 +561,256 @@ class Slave(Base):
         msg, voting_keyboard = yield self.get_verification_message(message_id, chat_id)
 
         moderation_msg = yield self.send_message(msg, chat_id=self.moderator_chat_id, reply_markup=voting_keyboard)
-        cur = yield self.db.execute('SELECT moderation_message_id FROM incoming_messages WHERE id = %s AND '
-                                    'original_chat_id = %s AND bot_id = %s', (message_id, chat_id, self.bot_id))
-        row = cur.fetchone()
-        if row and row[0]:
-            self.edit_message_text(pgettext('Newer poll for this message posted below', '_Outdated_'),
-                                   chat_id=self.moderator_chat_id, message_id=row[0], parse_mode=self.PARSE_MODE_MD)
+        poll = yield self.get_poll(message_id, chat_id)
+        if poll and poll['moderation_message_id']:
+            self.edit_moderation_message(pgettext('Newer poll for this message posted below', '_Outdated_'),
+                                         self.moderator_chat_id, poll['moderation_message_id'],
+                                         parse_mode=self.PARSE_MODE_MD)
 
         yield self.db.execute('UPDATE incoming_messages SET moderation_message_id = %s, moderation_fwd_message_id = %s '
-                              'WHERE id = %s AND original_chat_id = %s AND bot_id = %s',
-                              (moderation_msg['message_id'], fwd['message_id'], message_id, chat_id, self.bot_id))
+                              'WHERE id = %s AND original_chat_id = %s AND bot_id = %s AND created_at >= %s',
+                              (moderation_msg['message_id'], fwd['message_id'], message_id, chat_id, self.bot_id,
+                               self.polls_since))
+        self.update_poll(message_id, chat_id, moderation_message_id=moderation_msg['message_id'],
+                         moderation_fwd_message_id=fwd['message_id'])
         yield self.db.execute('UPDATE registered_bots SET last_moderation_message_at = NOW() WHERE id = %s',
                               (self.bot_id,))
 
+    @coroutine
+    def get_poll(self, message_id, chat_id):
+        key = (int(chat_id), int(message_id))
+        poll = self.polls.get(key)
+        if poll is None:
+            query = 'SELECT ' + ', '.join(self.POLL_FIELDS) + ' FROM incoming_messages ' \
+                    'WHERE id = %s AND original_chat_id = %s AND bot_id = %s'
+            cur = yield self.db.execute(query + ' AND created_at >= %s', (message_id, chat_id, self.bot_id,
+                                                                          self.polls_since))
+            row = cur.fetchone()
+            if not row:
+                # Closed polls (e.g. replies to published messages) may be in any partition
+                cur = yield self.db.execute(query, (message_id, chat_id, self.bot_id))
+                row = cur.fetchone()
+            if not row:
+                return None
+
+            poll = dict(zip(self.POLL_FIELDS, row))
+            self.polls.set(key, poll)
+
+        return poll
+
+    def update_poll(self, message_id, chat_id, **fields):
+        poll = self.polls.get((int(chat_id), int(message_id)))
+        if poll is not None:
+            poll.update(fields)
+
+    def forget_poll(self, message_id, chat_id):
+        self.polls.pop((int(chat_id), int(message_id)))
+
+    @coroutine
+    def cast_vote(self, message_id, chat_id, user_id, yes, callback_query=None):
+        """
+        Returns cast_vote() result for this vote. Votes for the same poll coming in while the previous ones are being
+        written are applied together, followed by a single poll message update.
+        """
+        key = (int(chat_id), int(message_id))
+        future = Future()
+        if key in self._pending_votes:
+            self._pending_votes[key].append((user_id, yes, callback_query, future))
+        else:
+            self._pending_votes[key] = [(user_id, yes, callback_query, future)]
+            IOLoop.current().add_callback(self._votes_actor, key)
+
+        return (yield future)
+
+    @coroutine
+    def _votes_actor(self, key):
+        chat_id, message_id = key
+        while self._pending_votes.get(key):
+            votes = self._pending_votes[key]
+            self._pending_votes[key] = []
+            try:
+                results = yield self._apply_votes(message_id, chat_id, votes)
+            except Exception as e:
+                for vote in votes:
+                    vote[3].set_exception(e)
+                continue
+
+            # The poll message edit is rate limited per chat, the next votes are written without waiting for it
+            if self.early_callback_answer:
+                # Let the handlers answer callback queries while the poll message is being updated
+                self._resolve_votes(votes, results)
+                yield self._update_poll_message(message_id, chat_id, votes, results)
+            else:
+                edit = yield self._update_poll_message(message_id, chat_id, votes, results)
+                if edit is None:
+                    self._resolve_votes(votes, results)
+                else:
+                    IOLoop.current().add_future(edit, partial(self._resolve_votes, votes, results))
+
+        del self._pending_votes[key]
+
+    @staticmethod
+    def _resolve_votes(votes, results, edit=None):
+        for vote, result in zip(votes, results):
+            vote[3].set_result(result)
+
+    @coroutine
+    def _apply_votes(self, message_id, chat_id, votes):
+        # Every vote is still counted by cast_vote(), see schema.sql, but all of them in one statement
+        cur = yield self.db.execute('SELECT c.opened, c.prev_vote, c.updated, c.yes_count, c.total_count, '
+                                    'c.became_success, c.became_fail, c.message '
+                                    'FROM unnest(%s::BIGINT[], %s::BOOLEAN[]) WITH ORDINALITY AS v (user_id, yes, n) '
+                                    'CROSS JOIN LATERAL cast_vote(%s, v.user_id, %s, %s, v.yes, %s, %s) c ORDER BY v.n',
+                                    ([vote[0] for vote in votes], [vote[1] for vote in votes], self.bot_id, message_id,
+                                     chat_id, bool(self.settings.get('allow_vote_switch')),
+                                     self.settings.get('votes', 5)))
+        results = cur.fetchall()
+
+        if any(result[2] or result[5] or result[6] for result in results):
+            yes_count, total_count = results[-1][3:5]
+            poll_state = dict(yes_count=yes_count, no_count=total_count - yes_count)
+            if any(result[5] for result in results):
+                poll_state['is_voting_success'] = True
+            if any(result[6] for result in results):
+                poll_state['is_voting_fail'] = True
+            self.update_poll(message_id, chat_id, **poll_state)
+
+        return results
+
+    @coroutine
+    def _update_poll_message(self, message_id, chat_id, votes, results):
+        """
+        Returns the future of the scheduled poll message edit, if there is one.
+        """
+        callback_queries = [vote[2] for vote in votes if vote[2]]
+        if not callback_queries:
+            return
+
+        opened, _, _, yes_count, total_count = results[-1][:5]
+        required_votes = self.settings.get('votes', 5)
+
+        if any(result[6] for result in results):
+            # Poll message is updated by decline_message
+            return
+        elif not opened or yes_count >= required_votes:
+            voting_finished = True
+        elif total_count - yes_count >= required_votes:
+            return
+        elif any(result[2] and (self.settings.get('public_vote', True) or result[1] is None)
+                 for vote, result in zip(votes, results) if vote[2]):
+            # Change poll's message only when message is actually changed: this happens if user wasn't voted
+            # previously or then votes are publicly visible
+            voting_finished = False
+        else:
+            return
+
+        try:
+            msg, keyboard = yield self.get_verification_message(message_id, chat_id, voting_finished)
+        except:
+            logging.exception('[bot #%d] Unable to update poll message (#%s from %s)', self.bot_id, message_id,
+                              chat_id)
+            return
+
+        poll_message = callback_queries[-1]['message']
+        edit = self.edit_moderation_message(msg, poll_message['chat']['id'], poll_message['message_id'],
+                                            reply_markup=keyboard)
+        IOLoop.current().add_future(edit, partial(self._poll_message_edited, message_id, chat_id))
+        return edit
+
+    def _poll_message_edited(self, message_id, chat_id, f):
+        if f.exception():
+            logging.error('[bot #%d] Unable to update poll message (#%s from %s)', self.bot_id, message_id, chat_id,
+                          exc_info=f.exc_info())
+
+    def edit_moderation_message(self, text, chat_id, message_id, **kwargs):
+        """
+        Edits are delayed for `edit_window` seconds and rate limited per chat; only the latest content requested for
+        the message during that time is sent, and nothing is sent when it's the same as the previous one.
+        """
+        key = (chat_id, message_id)
+        future = Future()
+        if key in self._pending_edits:
+            pending = self._pending_edits[key]
+            pending['text'], pending['kwargs'] = text, kwargs
+            pending['futures'].append(future)
+        else:
+            self._pending_edits[key] = dict(text=text, kwargs=kwargs, futures=[future])
+            IOLoop.current().add_callback(self._flush_edit, key)
+
+        return future
+
+    @staticmethod
+    def _edit_fingerprint(text, kwargs):
+        # Reply markups are serialized by their attributes, the same ones that end up in the request
+        def attributes(obj):
+            if hasattr(obj, '__dict__'):
+                return vars(obj)
+            if hasattr(obj, '__slots__'):
+                return {name: getattr(obj, name, None) for name in obj.__slots__}
+            raise TypeError('%r is not serializable' % obj)
+
+        try:
+            params = json.dumps(dict(kwargs, text=str(text)), sort_keys=True, default=attributes)
+        except (TypeError, ValueError):
+            # Unknown content is always sent
+            return None
+
+        return hashlib.sha1(params.encode('utf-8')).hexdigest()
+
+    def _reserve_chat_edit(self, chat_id):
+        """
+        Token bucket per chat: takes a token and returns how many seconds to wait until it's actually available.
+        Tokens go negative while edits are queued, so every following edit waits for its own turn.
+        """
+        now = time()
+        tokens, updated_at = self._chat_edit_buckets.get(chat_id, (self.MODERATION_CHAT_EDITS_BURST, now))
+        tokens = min(self.MODERATION_CHAT_EDITS_BURST,
+                     tokens + (now - updated_at) * self.MODERATION_CHAT_EDITS_PER_SECOND) - 1
+        self._chat_edit_buckets[chat_id] = (tokens, now)
+        return max(0, -tokens / self.MODERATION_CHAT_EDITS_PER_SECOND)
+
+    @coroutine
+    def _flush_edit(self, key):
+        chat_id, message_id = key
+        yield sleep(max(self.edit_window, self._reserve_chat_edit(chat_id)))
+
+        pending = self._pending_edits.pop(key)
+        fingerprint = self._edit_fingerprint(pending['text'], pending['kwargs'])
+        result = None
+        try:
+            if fingerprint is None or self._edit_fingerprints.get(key) != fingerprint:
+                try:
+                    result = yield self.edit_message_text(pending['text'], chat_id=chat_id, message_id=message_id,
+                                                          **pending['kwargs'])
+                except ApiError as e:
+                    if e.code != 400 or 'message is not modified' not in e.description:
+                        raise
+                self._edit_fingerprints.set(key, fingerprint)
+        except Exception as e:
+            self._edit_fingerprints.pop(key)
+            for future in pending['futures']:
+                future.set_exception(e)
+        else:
+            for future in pending['futures']:
+                future.set_result(result)
+
     @coroutine
     def get_message_fwd_id(self, chat_id, message_id):
         try:
-            cur = yield self.db.execute('SELECT moderation_fwd_message_id FROM incoming_messages WHERE id = %s AND '
-                                        'original_chat_id = %s AND bot_id = %s', (message_id, chat_id, self.bot_id))
-            row = cur.fetchone()
-            if row and row[0]:
-                return row[0]
+            poll = yield self.get_poll(message_id, chat_id)
+            if poll and poll['moderation_fwd_message_id']:
+                return poll['moderation_fwd_message_id']
         except:
             return
 
     @coroutine
     def _build_voting_status(self, message_id, chat_id, voting_finished):
-        cur = yield self.db.execute('SELECT count(*), sum(vote_yes::int) FROM votes_history WHERE message_id = %s AND '
-                                    'original_chat_id = %s', (message_id, chat_id))
+        poll = yield self.get_poll(message_id, chat_id)
 
-        total_votes, approves = cur.fetchone()
+        if poll:
+            total_votes, approves = poll['yes_count'] + poll['no_count'], poll['yes_count']
+        else:
+            total_votes, approves = 0, 0
         if total_votes == 0:
             percent_yes = 0
             percent_no = 0
@@ -372,11 +855,7 @@ class Slave(Base):
             message.append(pgettext('Poll finished', 'Poll is closed.'))
             tags = ''
             if approves >= self.settings['votes']:
-                cur = yield self.db.execute('SELECT is_published FROM incoming_messages WHERE bot_id = %s AND '
-                                            'id = %s AND original_chat_id = %s', (self.bot_id, message_id, chat_id))
-
-                row = cur.fetchone()
-                if row and row[0]:
+                if poll and poll['is_published']:
                     msg = pgettext('Vote successful, message is published', 'The message is published.')
                     if self.settings.get('tag_polls'):
                         tags = ' #accepted'
@@ -421,11 +900,9 @@ class Slave(Base):
         if voting_finished:
             voting_keyboard = None
         else:
-            cur = yield self.db.execute('SELECT owner_id FROM incoming_messages WHERE bot_id = %s AND id = %s AND '
-                                        'original_chat_id = %s', (self.bot_id, message_id, chat_id))
-            row = cur.fetchone()
-            if row and row[0]:
-                message_owner_id = row[0]
+            poll = yield self.get_poll(message_id, chat_id)
+            if poll and poll['owner_id']:
+                message_owner_id = poll['owner_id']
             else:
                 message_owner_id = chat_id
             m = pgettext('Verification message', 'What will we do with this message?')
@@ -1,82 +1,561 @@
 import logging
+from collections import deque
+from os import getpid
+from socket import gethostname
+from time import time
 from traceback import format_exception
 from ujson import loads, dumps
 
-from datetime import timedelta
+from datetime import date, datetime, timedelta
 from tornado.concurrent import Future
-from tornado.gen import coroutine, with_timeout
+from tornado.gen import coroutine, with_timeout, sleep, WaitIterator
+from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
-from tornado.locks import Event
+from tornado.locks import Event, Semaphore
 
 from tobot import CommandFilterTextCmd, CommandFilterNewChatMember, CommandFilterGroupChatCreated, \
     CommandFilterSupergroupChatCreated
-from .queues import slaveholder_queues, QUEUE_SLAVEHOLDER_NEW_BOT, QUEUE_SLAVEHOLDER_GET_BOT_INFO, \
-    QUEUE_SLAVEHOLDER_GET_MODERATION_GROUP, QUEUE_BOTERATOR_BOT_REVOKE
+from .queues import slaveholder_queues, holder_queue, QUEUE_SLAVEHOLDER_NEW_BOT, QUEUE_SLAVEHOLDER_GET_BOT_INFO, \
+    QUEUE_SLAVEHOLDER_GET_MODERATION_GROUP, QUEUE_SLAVEHOLDER_STOP_BOT, QUEUE_BOTERATOR_BOT_REVOKE
 from tobot.telegram import Api, ApiError
+from .leases import LEASE_KEY
+from .notifications import USER_BANS_CHANNEL
+from .scheduler import JobScheduler
+from .stages import StagesStore
+from .user_profiles import UserProfiles
 from .slave import Slave
+from .bot_api import BotApiError
+from .webhook import webhook_application, get_webhook_info, delete_webhook, is_own_webhook
 
 
 class SlaveHolder:
-    def __init__(self, db, queue):
+    # Holder is considered overloaded when it receives this times more updates than the least loaded peer
+    REBALANCE_RATIO = 1.5
+    REBALANCE_MAX_MOVES = 5
+    # Time for the target holder to start waiting for the lease of a handed off bot
+    HANDOFF_TIMEOUT = 10
+
+    WARMUP_PROGRESS_INTERVAL = 10
+    SCHEDULER_STATS_INTERVAL = 300
+
+    NOTIFICATIONS_CHECK_INTERVAL = 30
+
+    EXPIRED_VOTINGS_CHECK_INTERVAL = 600
+    EXPIRED_VOTINGS_PAGE_SIZE = 500
+    EXPIRED_VOTINGS_CONCURRENCY = 10
+    STAGES_SWEEP_INTERVAL = 3600
+
+    PARTITIONED_TABLES = ('incoming_messages', 'votes_history')
+    PARTITIONS_CHECK_INTERVAL = 86400
+    PARTITIONS_AHEAD_MONTHS = 3
+
+    def __init__(self, db, queue, shard=0, shards_count=1, leases=None, lease_check_interval=30,
+                 rebalance_interval=0, startup_concurrency=20, startup_rate=10, webhook_url=None, webhook_port=None,
+                 hibernate_after=0, hibernation_poll_interval=60, edit_window=0.5, early_callback_answer=True,
+                 notifications=None):
         self.db = db
         self.slaves = {}
         self._finished = Event()
         self._finished.set()
         self.queue = queue
+        self.shard = shard
+        self.shards_count = shards_count
+        self.leases = leases
+        self.lease_check_interval = lease_check_interval
+        self.rebalance_interval = rebalance_interval
+        self.updates_rates = {}
+        self._updates_counters = {}
+        self._rates_updated_at = time()
+        self._rebalanced_at = time()
+        self.startup_rate = startup_rate
+        self.webhook_url = webhook_url
+        self.webhook_port = webhook_port
+        self._webhook_server = None
+        self.slave_options = dict(hibernate_after=hibernate_after, hibernation_poll_interval=hibernation_poll_interval,
+                                  edit_window=edit_window, early_callback_answer=early_callback_answer)
+        self.scheduler = JobScheduler()
+        self.profiles = UserProfiles(db)
+        self.stages_store = StagesStore(db)
+        self.notifications = notifications
+        if notifications:
+            notifications.listen(USER_BANS_CHANNEL, self._on_user_ban)
+        self._startup_queue = deque()
+        self._startup_slots = Semaphore(startup_concurrency)
+        self._warming_up = False
+        self._warmup_logged_at = 0
+        self.warmup_stats = {
+            'scheduled': 0,
+            'serving': 0,
+            'failed': 0,
+            'skipped': 0,
+            'started_at': None,
+            'finished_at': None,
+        }
+
+        if leases:
+            self.holder_id = '%s-%d' % (gethostname(), getpid())
+        else:
+            self.holder_id = 'shard%d' % shard
+
+        self.holder_queues = {}
+        if shards_count > 1 or leases:
+            self.holder_queues = {
+                holder_queue(queue_name, self.holder_id): queue_name
+                for queue_name in slaveholder_queues()
+                }
+        self.queues = slaveholder_queues() + list(self.holder_queues.keys())
 
     @coroutine
     def start(self):
         self._finished.clear()
-        logging.debug('Starting slave-holder')
+        # Bots can't store messages until partitions for the current month exist
+        yield self._create_partitions()
 
-        cur = yield self.db.execute('SELECT * FROM registered_bots WHERE active = TRUE')
-        columns = [i[0] for i in cur.description]
+        if self.webhook_url:
+            logging.debug('Receiving webhooks for %s on port %d', self.webhook_url, self.webhook_port)
+            self._webhook_server = HTTPServer(webhook_application(self.slaves))
+            self._webhook_server.listen(self.webhook_port)
 
-        while True:
-            row = cur.fetchone()
-            if not row:
-                break
-
-            row = dict(zip(columns, row))
-            self._start_bot(**row)
+        if self.leases:
+            logging.debug('Starting slave-holder in lease mode, capacity %d', self.leases.capacity)
+            yield self.leases.connect()
+            yield self._claim_bots()
+            yield self._heartbeat()
+            IOLoop.current().add_timeout(timedelta(seconds=self.lease_check_interval), self._check_leases)
+        else:
+            logging.debug('Starting slave-holder, shard %d of %d', self.shard + 1, self.shards_count)
+            bots = yield self._fetch_bots('active = TRUE AND id %% %s = %s '
+                                          'ORDER BY last_moderation_message_at DESC NULLS LAST',
+                                          (self.shards_count, self.shard))
+            self._schedule_start(bots)
 
-        listen_future = self.queue.listen(slaveholder_queues(), self.queue_handler)
+        self.scheduler.add(('scheduler_stats',), self._log_scheduler_stats, self.SCHEDULER_STATS_INTERVAL)
+        if self.notifications:
+            yield self.notifications.connect()
+            self.scheduler.add(('notifications',), self._check_notifications, self.NOTIFICATIONS_CHECK_INTERVAL)
+        self.scheduler.add(('expired_votings',), self._decline_expired_votings, self.EXPIRED_VOTINGS_CHECK_INTERVAL)
+        self.scheduler.add(('stages_sweep',), self.stages_store.sweep, self.STAGES_SWEEP_INTERVAL)
+        self.scheduler.add(('partitions',), self._create_partitions, self.PARTITIONS_CHECK_INTERVAL)
+        listen_future = self.queue.listen(self.queues, self.queue_handler)
 
         try:
             yield self._finished.wait()
         finally:
-            self.queue.stop(slaveholder_queues())
+            self.scheduler.remove(('scheduler_stats',))
+            if self.notifications:
+                self.scheduler.remove(('notifications',))
+                self.notifications.close()
+            self.scheduler.remove(('expired_votings',))
+            self.scheduler.remove(('stages_sweep',))
+            self.scheduler.remove(('partitions',))
+            self.queue.stop(self.queues)
             yield listen_future
+            if self._webhook_server:
+                self._webhook_server.stop()
+            yield self.profiles.flush()
+            yield self.stages_store.flush()
+            if self.leases:
+                self.leases.close()
+                yield self.db.execute('DELETE FROM slave_holders WHERE holder_id = %s', (self.holder_id,))
+
+    @coroutine
+    def _log_scheduler_stats(self):
+        stats = self.scheduler.lag_stats()
+        self.scheduler.reset_stats()
+        logging.info('Scheduler: %(jobs)d jobs, %(runs)d runs (%(failures)d failed, %(skipped)d skipped), '
+                     'lag avg %(lag_avg).2fs, max %(lag_max).2fs', stats)
+
+    def _on_user_ban(self, payload):
+        bot_id, user_id, banned = map(int, payload.split(':'))
+        slave = self.slaves.get(bot_id)
+        if slave:
+            slave['instance'].set_user_banned(user_id, banned)
+
+    @coroutine
+    def _check_notifications(self):
+        if self.notifications.connected:
+            return
+
+        logging.warning('Reconnecting to receive notifications')
+        yield self.notifications.connect()
+        # Bans made while the connection was down are unknown
+        for slave in list(self.slaves.values()):
+            if slave['instance'].banned_users is not None:
+                yield slave['instance'].load_banned_users()
+
+    @coroutine
+    def _create_partitions(self):
+        until = date.today() + timedelta(days=31 * self.PARTITIONS_AHEAD_MONTHS)
+        for table in self.PARTITIONED_TABLES:
+            cur = yield self.db.execute('SELECT create_monthly_partitions(%s, CURRENT_DATE, %s)', (table, until))
+            created = cur.fetchone()[0]
+            if created:
+                logging.info('Created %d partitions of %s', created, table)
+
+    @coroutine
+    def _decline_expired_votings(self):
+        bot_ids = sorted(bot_id for bot_id, slave in self.slaves.items() if slave['instance'].serving.is_set())
+        if not bot_ids:
+            return
+
+        now = datetime.now()
+        expire_before = [now - timedelta(hours=self.slaves[bot_id]['instance'].settings.get('vote_timeout', 24))
+                         for bot_id in bot_ids]
+        polls_since = [self.slaves[bot_id]['instance'].polls_since or now for bot_id in bot_ids]
+        slots = Semaphore(self.EXPIRED_VOTINGS_CONCURRENCY)
+        keyset = None
+        declined = 0
+
+        while not self._finished.is_set():
+            # Keyset pagination in the im_pending_die_idx order. Messages sharing created_at with the last one of the
+            # page may be skipped until the next run. The constant lower bound lets the planner skip old partitions.
+            query = ('SELECT im.bot_id, im.created_at, im.message, im.yes_count '
+                     'FROM incoming_messages im '
+                     'JOIN unnest(%s::BIGINT[], %s::TIMESTAMP[], %s::TIMESTAMP[]) AS b (bot_id, expire_before, since) '
+                     'ON b.bot_id = im.bot_id '
+                     'WHERE im.is_voting_success = FALSE AND im.is_voting_fail = FALSE '
+                     'AND im.created_at <= b.expire_before AND im.created_at >= b.since AND im.created_at >= %s ')
+            params = [bot_ids, expire_before, polls_since, min(polls_since)]
+            if keyset:
+                query += 'AND (im.bot_id > %s OR (im.bot_id = %s AND im.created_at < %s)) '
+                params += [keyset[0], keyset[0], keyset[1]]
+            query += 'ORDER BY im.bot_id, im.created_at DESC LIMIT %s'
+            params.append(self.EXPIRED_VOTINGS_PAGE_SIZE)
+
+            cur = yield self.db.execute(query, params)
+            rows = cur.fetchall()
+
+            declines = []
+            for bot_id, created_at, message, yes_votes in rows:
+                slave = self.slaves.get(bot_id)
+                if slave:
+                    declines.append(self._decline_expired_message(slots, slave['instance'], message, yes_votes))
+
+            yield declines
+            declined += len(declines)
+
+            if len(rows) < self.EXPIRED_VOTINGS_PAGE_SIZE:
+                break
+            keyset = rows[-1][:2]
+
+        if declined:
+            logging.debug('Declined %d expired messages', declined)
+
+    @coroutine
+    def _decline_expired_message(self, slots, slave, message, yes_votes):
+        with (yield slots.acquire()):
+            yield slave.decline_expired_message(message, yes_votes)
+
+    @coroutine
+    def _fetch_bots(self, condition, params=()):
+        cur = yield self.db.execute('SELECT * FROM registered_bots WHERE ' + condition, params)
+        columns = [i[0] for i in cur.description]
+
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+    @coroutine
+    def _claim_bots(self):
+        if self.leases.is_full:
+            return
+
+        bots = yield self._fetch_bots('active = TRUE AND NOT EXISTS (SELECT 1 FROM pg_locks WHERE '
+                                      "locktype = 'advisory' AND objsubid = 1 AND " + LEASE_KEY + ' = id) '
+                                      'ORDER BY last_moderation_message_at DESC NULLS LAST LIMIT %s',
+                                      (self.leases.capacity - len(self.leases.owned),))
+        claimed = []
+        for bot in bots:
+            if bot['id'] in self.slaves:
+                continue
+
+            acquired = yield self.leases.acquire(bot['id'])
+            if acquired:
+                claimed.append(bot)
+
+        self._schedule_start(claimed)
+
+    def _schedule_start(self, bots):
+        if not bots:
+            return
+
+        stats = self.warmup_stats
+        if stats['finished_at'] or not stats['started_at']:
+            stats.update(scheduled=0, serving=0, failed=0, skipped=0, started_at=time(), finished_at=None)
+
+        stats['scheduled'] += len(bots)
+        self._startup_queue.extend(bots)
+        if not self._warming_up:
+            self._warm_up()
+
+    @coroutine
+    def _warm_up(self):
+        self._warming_up = True
+        try:
+            while self._startup_queue and not self._finished.is_set():
+                yield self._startup_slots.acquire()
+                bot = self._startup_queue.popleft()
+                if bot['id'] in self.slaves or (self.leases and not self.leases.owns(bot['id'])):
+                    self._startup_slots.release()
+                    self.warmup_stats['skipped'] += 1
+                    self._warmup_progress()
+                    continue
+
+                slave_info = self._start_bot(**bot)
+                IOLoop.current().add_future(self._wait_serving(slave_info), self._warmup_step_done)
+
+                if self.startup_rate:
+                    yield sleep(1 / self.startup_rate)
+        finally:
+            self._warming_up = False
+
+    @coroutine
+    def _wait_serving(self, slave_info):
+        wait = WaitIterator(slave_info['instance'].serving.wait(), slave_info['future'])
+        try:
+            yield wait.next()
+        except:
+            pass
+
+        return slave_info['instance'].serving.is_set()
+
+    def _warmup_step_done(self, f):
+        self._startup_slots.release()
+        self.warmup_stats['serving' if f.result() else 'failed'] += 1
+        self._warmup_progress()
 
-    def _start_bot(self, **kwargs):
+    def _warmup_progress(self):
+        stats = self.warmup_stats
+        done = stats['serving'] + stats['failed'] + stats['skipped']
+        elapsed = time() - stats['started_at']
+        if done >= stats['scheduled'] and not self._startup_queue:
+            stats['finished_at'] = time()
+            logging.info('Warm-up finished in %.1fs: %d bots serving, %d failed, %d skipped', elapsed,
+                         stats['serving'], stats['failed'], stats['skipped'])
+        elif time() - self._warmup_logged_at >= self.WARMUP_PROGRESS_INTERVAL:
+            self._warmup_logged_at = time()
+            logging.info('Warm-up in progress for %.1fs: %d of %d bots serving, %d failed', elapsed,
+                         stats['serving'], stats['scheduled'], stats['failed'])
+
+    @coroutine
+    def _check_leases(self):
+        if self._finished.is_set():
+            return
+
+        try:
+            alive = yield self.leases.heartbeat()
+            if not alive:
+                for slave in self.slaves.values():
+                    slave['instance'].stop()
+                yield self.leases.connect()
+
+            yield self._claim_bots()
+            self._update_rates()
+            yield self._heartbeat()
+
+            if self.rebalance_interval and time() - self._rebalanced_at >= self.rebalance_interval:
+                self._rebalanced_at = time()
+                yield self._rebalance()
+        except:
+            logging.exception('Leases check failed')
+
+        if not self._finished.is_set():
+            IOLoop.current().add_timeout(timedelta(seconds=self.lease_check_interval), self._check_leases)
+
+    def _update_rates(self):
+        now = time()
+        elapsed = now - self._rates_updated_at
+        if elapsed <= 0:
+            return
+
+        counters = {
+            bot_id: slave['instance'].updates_count
+            for bot_id, slave in self.slaves.items()
+            }
+        self.updates_rates = {
+            bot_id: max(0, counter - self._updates_counters.get(bot_id, 0)) / elapsed
+            for bot_id, counter in counters.items()
+            }
+        self._updates_counters = counters
+        self._rates_updated_at = now
+
+    @coroutine
+    def _heartbeat(self):
+        yield self.db.execute("""
+            INSERT INTO slave_holders (holder_id, backend_pid, capacity, bots_count, updates_rate, heartbeat_at)
+            VALUES (%s, %s, %s, %s, %s, NOW())
+            ON CONFLICT ON CONSTRAINT slave_holders_pkey
+            DO UPDATE SET backend_pid = EXCLUDED.backend_pid, capacity = EXCLUDED.capacity,
+              bots_count = EXCLUDED.bots_count, updates_rate = EXCLUDED.updates_rate,
+              heartbeat_at = EXCLUDED.heartbeat_at
+        """, (self.holder_id, self.leases.backend_pid, self.leases.capacity, len(self.slaves),
+              sum(self.updates_rates.values())))
+
+    @coroutine
+    def _bot_holder(self, bot_id):
+        cur = yield self.db.execute('SELECT sh.holder_id FROM pg_locks l '
+                                    'JOIN slave_holders sh ON sh.backend_pid = l.pid '
+                                    "WHERE l.locktype = 'advisory' AND l.objsubid = 1 AND " + LEASE_KEY + ' = %s',
+                                    (bot_id,))
+        row = cur.fetchone()
+        if row:
+            return row[0]
+
+    @coroutine
+    def _holder_free_slots(self, holder_id):
+        cur = yield self.db.execute('SELECT sh.capacity - COUNT(l.pid) FROM slave_holders sh '
+                                    "LEFT JOIN pg_locks l ON l.pid = sh.backend_pid AND l.locktype = 'advisory' "
+                                    'AND l.objsubid = 1 AND l.granted WHERE sh.holder_id = %s GROUP BY sh.capacity',
+                                    (holder_id,))
+        row = cur.fetchone()
+        return row[0] if row else 0
+
+    @coroutine
+    def _rebalance(self):
+        cur = yield self.db.execute('SELECT holder_id, updates_rate FROM slave_holders WHERE holder_id != %s AND '
+                                    'bots_count < capacity AND heartbeat_at >= NOW() - INTERVAL \'1 second\' * %s '
+                                    'ORDER BY updates_rate LIMIT 1',
+                                    (self.holder_id, self.lease_check_interval * 3))
+        row = cur.fetchone()
+        if not row:
+            return
+
+        target_id, target_rate = row
+        own_rate = sum(self.updates_rates.values())
+        if own_rate <= target_rate * self.REBALANCE_RATIO:
+            return
+
+        logging.info('Rebalancing: %.2f updates/s here, %.2f updates/s on %s', own_rate, target_rate, target_id)
+
+        # Move the noisiest bots which don't make the target busier than we are
+        gap = own_rate - target_rate
+        moved = 0
+        for bot_id, rate in sorted(self.updates_rates.items(), key=lambda item: item[1], reverse=True):
+            if moved >= self.REBALANCE_MAX_MOVES or rate <= 0:
+                break
+
+            if rate * 2 > gap or bot_id not in self.slaves:
+                continue
+
+            # The target could have got other bots since the last heartbeat, including the ones just handed off
+            free_slots = yield self._holder_free_slots(target_id)
+            if free_slots <= 0:
+                logging.debug('Rebalancing stopped: %s is full', target_id)
+                break
+
+            yield self._stop_bot(bot_id, target_id)
+            gap -= rate * 2
+            moved += 1
+
+    @coroutine
+    def _stop_bot(self, bot_id, target_holder_id=None):
+        slave = self.slaves[bot_id]
+        slave['stopping'] = True
+        slave['instance'].stop()
+        try:
+            yield slave['future']
+        except:
+            pass
+
+        try:
+            yield slave['instance'].confirm_updates()
+        except:
+            logging.exception('[bot#%s] Unable to confirm processed updates', bot_id)
+
+        if target_holder_id:
+            # The lease is kept until the target waits for it, otherwise a peer could claim the bot in between
+            logging.info('[bot#%s] Handing off to %s', bot_id, target_holder_id)
+            yield self.queue.send(holder_queue(QUEUE_SLAVEHOLDER_NEW_BOT, target_holder_id),
+                                  dumps(dict(id=bot_id, last_update_id=slave['instance'].last_update_id,
+                                             handoff=True)))
+            if self.leases:
+                waiting = yield self.leases.wait_for_successor(bot_id, self.HANDOFF_TIMEOUT)
+                if not waiting:
+                    logging.warning('[bot#%s] %s is not taking over, releasing the lease', bot_id, target_holder_id)
+        else:
+            logging.info('[bot#%s] Stopped', bot_id)
+
+        if self.leases:
+            yield self.leases.release(bot_id)
+
+    def bot_shard(self, bot_id):
+        return int(bot_id) % self.shards_count
+
+    @staticmethod
+    def _queue_body_bot_id(body):
+        if 'id' in body:
+            return body['id']
+        return body['token'].split(':')[0]
+
+    def _start_bot(self, last_update_id=None, **kwargs):
         @coroutine
         def listen_done(f: Future):
             logging.debug('[bot#%s] Terminated', kwargs['id'])
+            del self.slaves[kwargs['id']]
+            if slave_info.get('stopping'):
+                return
+
+            restarting = False
             e = f.exception()
             if e:
                 logging.debug('[bot#%s] Got exception: %s %s', kwargs['id'], format_exception(*f.exc_info()))
-                if isinstance(e, ApiError) and e.code == 401:
+                if isinstance(e, (ApiError, BotApiError)) and e.code == 401:
                     logging.warning('[bot#%d] Disabling due to connection error', kwargs['id'])
                     yield self.queue.send(QUEUE_BOTERATOR_BOT_REVOKE, dumps(dict(error=str(e), **kwargs)))
-                elif isinstance(e, ApiError) and e.code == 400 and 'chat not found' in e.description and \
-                    str(kwargs['moderator_chat_id']) in e.request_body:
+                elif isinstance(e, (ApiError, BotApiError)) and e.code == 400 and \
+                    'chat not found' in e.description and str(kwargs['moderator_chat_id']) in e.request_body:
                     logging.warning('[bot#%d] Disabling due to unavailable moderator chat', kwargs['id'])
                     yield self.queue.send(QUEUE_BOTERATOR_BOT_REVOKE, dumps(dict(error=str(e), **kwargs)))
-                elif isinstance(e, ApiError) and e.code == 409 and 'webhook is active' in e.description:
-                    logging.warning('[bot#%d] Disabling due to misconfigured webhook', kwargs['id'])
-                    yield self.queue.send(QUEUE_BOTERATOR_BOT_REVOKE, dumps(dict(error=str(e), **kwargs)))
+                elif isinstance(e, (ApiError, BotApiError)) and e.code == 409 and 'webhook is active' in e.description:
+                    own_webhook = yield self._drop_own_webhook(kwargs['token'])
+                    if own_webhook:
+                        logging.info('[bot#%d] Switched from webhook to polling', kwargs['id'])
+                        restarting = True
+                        IOLoop.current().add_timeout(timedelta(seconds=5), self._restart_bot,
+                                                     last_update_id=slave.last_update_id, **kwargs)
+                    else:
+                        logging.warning('[bot#%d] Disabling due to misconfigured webhook', kwargs['id'])
+                        yield self.queue.send(QUEUE_BOTERATOR_BOT_REVOKE, dumps(dict(error=str(e), **kwargs)))
                 else:
-                    IOLoop.current().add_timeout(timedelta(seconds=5), self._start_bot, **kwargs)
+                    restarting = True
+                    IOLoop.current().add_timeout(timedelta(seconds=5), self._restart_bot,
+                                                 last_update_id=slave.last_update_id, **kwargs)
 
-            del self.slaves[kwargs['id']]
+            if self.leases and not restarting:
+                yield self.leases.release(kwargs['id'])
 
-        slave = Slave(db=self.db, **kwargs)
-        slave_listen_f = slave.start()
-        self.slaves[kwargs['id']] = {
+        slave = Slave(db=self.db, webhook_url=self.webhook_url, scheduler=self.scheduler, profiles=self.profiles,
+                      stages_store=self.stages_store, **dict(self.slave_options, **kwargs))
+        slave_listen_f = slave.start(last_update_id)
+        slave_info = {
             'future': slave_listen_f,
             'instance': slave,
         }
+        self.slaves[kwargs['id']] = slave_info
         IOLoop.current().add_future(slave_listen_f, listen_done)
+        return slave_info
+
+    @coroutine
+    def _drop_own_webhook(self, token):
+        # Webhook set by a slave-holder in the webhook mode is fine, it's just the time to start polling
+        try:
+            info = yield get_webhook_info(token)
+            if not info.get('url') or not is_own_webhook(token, info['url']):
+                return False
+
+            yield delete_webhook(token)
+            return True
+        except BotApiError:
+            logging.exception('Unable to check the webhook')
+            return False
+
+    def _restart_bot(self, **kwargs):
+        if self._finished.is_set() or kwargs['id'] in self.slaves:
+            return
+
+        if self.leases and not self.leases.owns(kwargs['id']):
+            logging.debug('[bot#%s] Lease lost, not restarting', kwargs['id'])
+            return
+
+        self._start_bot(**kwargs)
 
     def stop(self):
         logging.info('Stopping slave-holder')
@@ -89,12 +568,49 @@ class SlaveHolder:
     def queue_handler(self, queue_name, body):
         body = loads(body.decode('utf-8'))
 
+        direct = queue_name in self.holder_queues
+        if direct:
+            queue_name = self.holder_queues[queue_name]
+        elif self.shards_count > 1:
+            bot_shard = self.bot_shard(self._queue_body_bot_id(body))
+            if bot_shard != self.shard:
+                logging.debug('Routing %s to shard %d', queue_name, bot_shard)
+                yield self.queue.send(holder_queue(queue_name, 'shard%d' % bot_shard), dumps(body))
+                return
+
         if queue_name == QUEUE_SLAVEHOLDER_NEW_BOT:
+            handoff = body.get('handoff')
+            if handoff:
+                bots = yield self._fetch_bots('active = TRUE AND id = %s', (body['id'],))
+                if not bots:
+                    return
+                body = dict(bots[0], last_update_id=body['last_update_id'])
+
+            if self.leases:
+                if handoff:
+                    acquired = yield self.leases.take_over(body['id'], self.HANDOFF_TIMEOUT)
+                else:
+                    acquired = yield self.leases.acquire(body['id'])
+                if not acquired:
+                    logging.debug('[bot#%s] Unable to lease, leaving the bot for peers', body['id'])
+                    return
+
             self._start_bot(**body)
+        elif queue_name == QUEUE_SLAVEHOLDER_STOP_BOT:
+            if body['id'] in self.slaves:
+                yield self._stop_bot(body['id'], body.get('target') if self.leases else None)
+            elif self.leases and not direct:
+                holder_id = yield self._bot_holder(body['id'])
+                if holder_id:
+                    yield self.queue.send(holder_queue(queue_name, holder_id), dumps(body))
         elif queue_name == QUEUE_SLAVEHOLDER_GET_BOT_INFO:
             bot = Api(body['token'], lambda x: None)
 
-            if bot.bot_id in self.slaves:
+            leased = bot.bot_id in self.slaves
+            if not leased and self.leases:
+                leased = yield self.leases.is_leased(bot.bot_id)
+
+            if leased:
                 logging.debug('[bot#%s] Already registered', bot.bot_id)
                 yield self.queue.send(body['reply_to'], dumps(dict(error='duplicate')))
 
@@ -108,6 +624,19 @@ class SlaveHolder:
 
             yield self.queue.send(body['reply_to'], dumps(ret))
         elif queue_name == QUEUE_SLAVEHOLDER_GET_MODERATION_GROUP:
+            bot_id = int(self._queue_body_bot_id(body))
+            # Re-registration of a bot served through a webhook
+            drop_webhook = self.webhook_url and bot_id not in self.slaves
+            if drop_webhook and self.leases:
+                leased = yield self.leases.is_leased(bot_id)
+                if leased:
+                    # The webhook belongs to a peer serving the bot, the request is for it to handle
+                    drop_webhook = False
+                    holder_id = yield self._bot_holder(bot_id)
+                    if holder_id and not direct:
+                        yield self.queue.send(holder_queue(queue_name, holder_id), dumps(body))
+                        return
+
             update_with_command_f = Future()
             timeout_f = with_timeout(timedelta(seconds=body['timeout']), update_with_command_f)
 
@@ -148,6 +677,9 @@ class SlaveHolder:
             attach_cmd_filter = CommandFilterTextCmd('/attach')
             bot_added = CommandFilterNewChatMember(bot.bot_id)
 
+            if drop_webhook:
+                yield self._drop_own_webhook(body['token'])
+
             logging.debug('[bot#%s] Waiting for moderation group', bot.bot_id)
             bot.wait_commands()
         else:
@@ -0,0 +1,134 @@
+import logging
+from datetime import datetime
+
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+from tornado.locks import Lock
+from ujson import dumps
+
+from tobot.stages import PersistentStages
+from .cache import LRUCache
+
+# Cached "no stage" marker, differs from a cache miss
+_NO_STAGE = (None, {}, None)
+
+
+class StagesStore:
+    """
+    Write-behind storage of the conversation stages of all the bots of a process. Stages are served from memory, changes
+    are written to the `stages` table with a single upsert and a single delete every `flush_interval` seconds or once
+    `flush_size` of them are pending. Stages not changed for `ttl` seconds are removed by sweep().
+    """
+
+    def __init__(self, db, flush_interval=0.5, flush_size=500, cache_size=100000, ttl=86400):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.ttl = ttl
+        self._stages = LRUCache(cache_size, ttl)
+        # None stands for a stage to be deleted
+        self._pending = {}
+        self._flushing = {}
+        self._flush_timeout = None
+        self._lock = Lock()
+
+    def stages(self, bot_id):
+        return BufferedStages(bot_id, self.db, self)
+
+    @coroutine
+    def get(self, key):
+        for changes in (self._pending, self._flushing):
+            if key in changes:
+                return changes[key] or _NO_STAGE
+
+        stage = self._stages.get(key)
+        if stage is None:
+            cur = yield self.db.execute('SELECT stage, data, created_at FROM stages WHERE bot_id = %s AND key = %s',
+                                        key)
+            row = cur.fetchone()
+            stage = tuple(row) if row else _NO_STAGE
+            # The stage could be changed while it was being read
+            if key in self._pending or key in self._flushing:
+                return (yield self.get(key))
+
+            self._stages.set(key, stage)
+
+        return stage
+
+    def set(self, key, stage):
+        self._stages.set(key, stage or _NO_STAGE)
+        self._pending[key] = stage
+        if len(self._pending) >= self.flush_size:
+            IOLoop.current().add_callback(self.flush)
+        elif self._flush_timeout is None:
+            self._flush_timeout = IOLoop.current().call_later(self.flush_interval, self.flush)
+
+    @coroutine
+    def flush(self):
+        with (yield self._lock.acquire()):
+            if self._flush_timeout is not None:
+                IOLoop.current().remove_timeout(self._flush_timeout)
+                self._flush_timeout = None
+
+            if not self._pending:
+                return
+
+            self._flushing, self._pending = self._pending, {}
+            upserts = [(key, stage) for key, stage in self._flushing.items() if stage is not None]
+            deletes = [key for key, stage in self._flushing.items() if stage is None]
+            try:
+                if upserts:
+                    yield self.db.execute("""
+                        INSERT INTO stages (bot_id, key, stage, data, created_at)
+                        SELECT s.bot_id, s.key, s.stage, s.data::JSONB, s.created_at
+                        FROM unnest(%s::BIGINT[], %s::VARCHAR[], %s::VARCHAR[], %s::VARCHAR[], %s::TIMESTAMP[])
+                            AS s (bot_id, key, stage, data, created_at)
+                        ON CONFLICT ON CONSTRAINT stages_pkey
+                        DO UPDATE SET stage = EXCLUDED.stage, data = EXCLUDED.data, created_at = EXCLUDED.created_at
+                    """, ([key[0] for key, _ in upserts], [key[1] for key, _ in upserts],
+                          [stage[0] for _, stage in upserts], [dumps(stage[1]) for _, stage in upserts],
+                          [stage[2] for _, stage in upserts]))
+
+                if deletes:
+                    yield self.db.execute('DELETE FROM stages s USING unnest(%s::BIGINT[], %s::VARCHAR[]) '
+                                          'AS d (bot_id, key) WHERE s.bot_id = d.bot_id AND s.key = d.key',
+                                          ([key[0] for key in deletes], [key[1] for key in deletes]))
+            except Exception:
+                logging.exception('Unable to save %d stages', len(self._flushing))
+                # Keeping the failed changes unless they were overwritten in the meantime
+                failed, self._flushing = self._flushing, {}
+                failed.update(self._pending)
+                self._pending = failed
+                if self._flush_timeout is None:
+                    self._flush_timeout = IOLoop.current().call_later(self.flush_interval, self.flush)
+            else:
+                self._flushing = {}
+
+    @coroutine
+    def sweep(self):
+        cur = yield self.db.execute("DELETE FROM stages WHERE created_at < NOW() - %s * INTERVAL '1 second'",
+                                    (self.ttl,))
+        if cur.rowcount:
+            logging.debug('%d abandoned stages removed', cur.rowcount)
+
+
+class BufferedStages(PersistentStages):
+    """
+    PersistentStages of a bot backed by a shared StagesStore.
+    """
+
+    def __init__(self, bot_id, db, store):
+        super().__init__(bot_id, db)
+        self.store = store
+
+    @coroutine
+    def get(self, message):
+        return (yield self.store.get((self.bot_id, self.get_id(message))))
+
+    @coroutine
+    def set(self, message, stage_id, do_not_validate=False, **kwargs):
+        self.store.set((self.bot_id, self.get_id(message)), (stage_id, kwargs, datetime.now()))
+
+    @coroutine
+    def drop(self, message):
+        self.store.set((self.bot_id, self.get_id(message)), None)
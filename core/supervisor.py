@@ -0,0 +1,86 @@
+import errno
+import logging
+import os
+import signal
+import sys
+from collections import defaultdict, deque
+from time import sleep, time
+
+
+def fork_workers(workers_count, max_restarts=10, restarts_window=600, restart_delay=1):
+    """
+    Forks `workers_count` processes and keeps them running. Returns the worker id (0..workers_count-1) inside a
+    worker, never returns inside the supervisor: it exits once every worker is finished. Crashed workers are
+    restarted with the same id, unless a worker crashes more than `max_restarts` times within `restarts_window`
+    seconds; SIGTERM/SIGINT received by the supervisor are forwarded to all workers.
+    """
+    children = {}
+    stopping = False
+    restarts = defaultdict(deque)
+
+    def start_worker(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            return worker_id
+
+        logging.info('Worker #%d started with pid %d', worker_id, pid)
+        children[pid] = worker_id
+
+    def stop_workers(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    for worker_id in range(workers_count):
+        if start_worker(worker_id) is not None:
+            return worker_id
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+
+        if pid not in children:
+            continue
+
+        worker_id = children.pop(pid)
+        if stopping:
+            logging.info('Worker #%d (pid %d) stopped', worker_id, pid)
+            continue
+        elif os.WIFSIGNALED(status):
+            logging.warning('Worker #%d (pid %d) killed by signal %d, restarting', worker_id, pid,
+                            os.WTERMSIG(status))
+        elif os.WEXITSTATUS(status) != 0:
+            logging.warning('Worker #%d (pid %d) exited with status %d, restarting', worker_id, pid,
+                            os.WEXITSTATUS(status))
+        else:
+            logging.info('Worker #%d (pid %d) exited normally', worker_id, pid)
+            continue
+
+        now = time()
+        worker_restarts = restarts[worker_id]
+        worker_restarts.append(now)
+        while worker_restarts[0] < now - restarts_window:
+            worker_restarts.popleft()
+        if len(worker_restarts) > max_restarts:
+            stop_workers(signal.SIGTERM, None)
+            raise RuntimeError('Worker #%d restarted %d times in %d seconds, giving up' %
+                               (worker_id, len(worker_restarts), restarts_window))
+
+        sleep(restart_delay)
+        if start_worker(worker_id) is not None:
+            return worker_id
+
+    sys.exit(0)
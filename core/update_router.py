@@ -0,0 +1,70 @@
+from functools import wraps
+
+from tornado.concurrent import Future
+
+
+class UpdateRouter:
+    """
+    Cheap pre-check in front of the handlers filters. A routed handler declares the command or the callback data prefix
+    it serves and isn't even called for other updates, so an update no longer runs every filter and regexp of the
+    chain. Routes are declared on import, a single router serves all the bots.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.stats = {'called': 0, 'skipped': 0}
+        self._last_update = None
+        self._last_key = None
+
+    @staticmethod
+    def _key(kind, value):
+        # '/vote_1_2_yes@some_bot' -> ('command', 'vote'), 'ban_1_2_3' -> ('callback', 'ban')
+        value = value.split(None, 1)[0] if value.strip() else ''
+        return kind, value.lstrip('/').split('@', 1)[0].split('_', 1)[0].lower()
+
+    def update_key(self, kwargs):
+        update = kwargs.get('callback_query') or kwargs.get('message')
+        if update is None:
+            return None
+
+        # Every handler of the chain gets the same update, key is computed once
+        if update is self._last_update:
+            return self._last_key
+
+        if 'callback_query' in kwargs:
+            key = self._key('callback', update.get('data') or '')
+        elif update.get('text', '').startswith('/'):
+            key = self._key('command', update['text'])
+        else:
+            key = None
+
+        self._last_update, self._last_key = update, key
+        return key
+
+    def route(self, command=None, callback=None):
+        keys = set()
+        if command:
+            keys.add(self._key('command', command))
+        if callback:
+            keys.add(self._key('callback', callback))
+
+        def decorator(handler):
+            self.routes[handler.__module__ + '.' + handler.__name__] = keys
+
+            @wraps(handler)
+            def routed(bot, *args, **kwargs):
+                if self.update_key(kwargs) in keys:
+                    self.stats['called'] += 1
+                    return handler(bot, *args, **kwargs)
+
+                self.stats['skipped'] += 1
+                not_matched = Future()
+                not_matched.set_result(False)
+                return not_matched
+
+            return routed
+
+        return decorator
+
+
+router = UpdateRouter()
@@ -0,0 +1,70 @@
+import logging
+
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+from tornado.locks import Lock
+
+from .cache import LRUCache
+
+
+class UserProfiles:
+    """
+    Write-behind buffer for the users table. A profile is queued only when it differs from the last one saved, queued
+    profiles are saved with a single upsert every `flush_interval` seconds or once `flush_size` of them are pending.
+    """
+
+    def __init__(self, db, flush_interval=0.3, flush_size=500, cache_size=100000):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._saved = LRUCache(cache_size)
+        self._pending = {}
+        self._flush_timeout = None
+        self._lock = Lock()
+
+    @staticmethod
+    def _fingerprint(user):
+        return user['first_name'], user.get('last_name'), user.get('username')
+
+    def update(self, bot_id, user):
+        key = (bot_id, user['id'])
+        fingerprint = self._fingerprint(user)
+        if self._saved.get(key) == fingerprint:
+            return
+
+        self._saved.set(key, fingerprint)
+        self._pending[key] = fingerprint
+        if len(self._pending) >= self.flush_size:
+            IOLoop.current().add_callback(self.flush)
+        elif self._flush_timeout is None:
+            self._flush_timeout = IOLoop.current().call_later(self.flush_interval, self.flush)
+
+    @coroutine
+    def flush(self):
+        with (yield self._lock.acquire()):
+            if self._flush_timeout is not None:
+                IOLoop.current().remove_timeout(self._flush_timeout)
+                self._flush_timeout = None
+
+            if not self._pending:
+                return
+
+            pending, self._pending = self._pending, {}
+            keys = list(pending.keys())
+            try:
+                yield self.db.execute("""
+                    INSERT INTO users (bot_id, user_id, first_name, last_name, username, created_at, updated_at)
+                    SELECT u.bot_id, u.user_id, u.first_name, u.last_name, u.username, NOW(), NOW()
+                    FROM unnest(%s::BIGINT[], %s::BIGINT[], %s::VARCHAR[], %s::VARCHAR[], %s::VARCHAR[])
+                        AS u (bot_id, user_id, first_name, last_name, username)
+                    ON CONFLICT ON CONSTRAINT users_pkey
+                    DO UPDATE SET first_name = EXCLUDED.first_name,
+                     last_name = COALESCE(EXCLUDED.last_name, users.last_name),
+                     username = COALESCE(EXCLUDED.username, users.username), updated_at = EXCLUDED.updated_at
+                """, ([key[0] for key in keys], [key[1] for key in keys], [pending[key][0] for key in keys],
+                      [pending[key][1] for key in keys], [pending[key][2] for key in keys]))
+            except Exception:
+                logging.exception('Unable to save %d user profiles', len(keys))
+                # Saved again on the next message from the user
+                for key in keys:
+                    self._saved.pop(key)
@@ -0,0 +1,59 @@
+import hashlib
+import logging
+from ujson import loads
+
+from tornado.gen import coroutine
+from tornado.web import Application, RequestHandler, HTTPError
+
+from .bot_api import call_api, ALLOWED_UPDATES
+
+
+def webhook_path(token):
+    return '/%s/%s' % (token.split(':')[0], hashlib.sha256(token.encode('utf-8')).hexdigest())
+
+
+def is_own_webhook(token, url):
+    return url.endswith(webhook_path(token))
+
+
+def set_webhook(token, base_url):
+    # One connection at a time keeps updates ordered, the same way getUpdates does
+    return call_api(token, 'setWebhook', url=base_url.rstrip('/') + webhook_path(token), max_connections=1,
+                    allowed_updates=ALLOWED_UPDATES)
+
+
+def delete_webhook(token):
+    return call_api(token, 'deleteWebhook')
+
+
+def get_webhook_info(token):
+    return call_api(token, 'getWebhookInfo')
+
+
+class WebhookHandler(RequestHandler):
+    def initialize(self, slaves):
+        self.slaves = slaves
+
+    @coroutine
+    def post(self, bot_id, secret):
+        slave = self.slaves.get(int(bot_id))
+        if not slave or not is_own_webhook(slave['instance'].token, '/%s/%s' % (bot_id, secret)):
+            raise HTTPError(404)
+
+        if not slave['instance'].serving.is_set():
+            # Let Telegram retry the update, it will reach the bot once it is serving here or on another holder
+            raise HTTPError(503)
+
+        try:
+            update = loads(self.request.body.decode('utf-8'))
+        except ValueError:
+            logging.warning('[bot#%s] Malformed webhook update', bot_id)
+            raise HTTPError(400)
+
+        yield slave['instance'].process_webhook_update(update)
+
+
+def webhook_application(slaves):
+    return Application([
+        (r'.*/(\d+)/([0-9a-f]{64})/?', WebhookHandler, dict(slaves=slaves)),
+    ])
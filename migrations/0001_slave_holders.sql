@@ -0,0 +1,11 @@
+CREATE TABLE IF NOT EXISTS slave_holders (
+    holder_id character varying NOT NULL,
+    backend_pid integer NOT NULL,
+    capacity integer NOT NULL,
+    bots_count integer NOT NULL,
+    updates_rate real DEFAULT 0 NOT NULL,
+    heartbeat_at timestamp without time zone NOT NULL,
+    CONSTRAINT slave_holders_pkey PRIMARY KEY (holder_id)
+);
+
+ALTER TABLE slave_holders OWNER TO boterator;
@@ -0,0 +1,3 @@
+ALTER TABLE registered_bots ADD COLUMN IF NOT EXISTS moderator_chat_type character varying;
+ALTER TABLE registered_bots ADD COLUMN IF NOT EXISTS moderator_chat_admins bigint[];
+ALTER TABLE registered_bots ADD COLUMN IF NOT EXISTS moderator_chat_updated_at timestamp without time zone;
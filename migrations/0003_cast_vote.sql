@@ -0,0 +1,63 @@
+-- Keep the earliest vote of every user, duplicates were possible with concurrent taps
+DELETE FROM votes_history a USING votes_history b
+    WHERE a.user_id = b.user_id AND a.message_id = b.message_id AND a.original_chat_id = b.original_chat_id
+    AND a.id > b.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS votes_history_umo_uniq ON votes_history USING btree (user_id, message_id, original_chat_id);
+DROP INDEX IF EXISTS votes_history_umo_idx;
+
+CREATE OR REPLACE FUNCTION cast_vote(_user_id bigint, _message_id bigint, _original_chat_id bigint, _yes boolean, _allow_switch boolean, _votes_required integer, OUT opened boolean, OUT prev_vote boolean, OUT updated boolean, OUT yes_count integer, OUT total_count integer, OUT became_success boolean, OUT became_fail boolean, OUT message jsonb) RETURNS record
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    _msg incoming_messages%ROWTYPE;
+BEGIN
+    updated := FALSE;
+    became_success := FALSE;
+    became_fail := FALSE;
+
+    -- Locking the message serializes concurrent votes for it
+    SELECT * INTO _msg FROM incoming_messages
+        WHERE id = _message_id AND original_chat_id = _original_chat_id LIMIT 1 FOR UPDATE;
+    opened := FOUND AND _msg.is_voting_fail = _msg.is_published;
+
+    SELECT vote_yes INTO prev_vote FROM votes_history
+        WHERE user_id = _user_id AND message_id = _message_id AND original_chat_id = _original_chat_id;
+
+    IF opened THEN
+        IF prev_vote IS NULL THEN
+            INSERT INTO votes_history (user_id, message_id, original_chat_id, vote_yes, created_at)
+                VALUES (_user_id, _message_id, _original_chat_id, _yes, NOW())
+                ON CONFLICT (user_id, message_id, original_chat_id) DO NOTHING;
+            updated := FOUND;
+        ELSIF prev_vote <> _yes AND _allow_switch THEN
+            UPDATE votes_history SET vote_yes = _yes
+                WHERE user_id = _user_id AND message_id = _message_id AND original_chat_id = _original_chat_id;
+            updated := TRUE;
+        END IF;
+    END IF;
+
+    SELECT COALESCE(SUM(vote_yes::INT), 0), COUNT(*) INTO yes_count, total_count FROM votes_history
+        WHERE message_id = _message_id AND original_chat_id = _original_chat_id;
+
+    IF opened THEN
+        IF yes_count >= _votes_required THEN
+            IF NOT _msg.is_voting_success THEN
+                UPDATE incoming_messages SET is_voting_success = TRUE
+                    WHERE id = _message_id AND original_chat_id = _original_chat_id;
+                became_success := TRUE;
+            END IF;
+        ELSIF total_count - yes_count >= _votes_required AND NOT _msg.is_voting_success AND NOT _msg.is_voting_fail THEN
+            UPDATE incoming_messages SET is_voting_fail = TRUE
+                WHERE id = _message_id AND original_chat_id = _original_chat_id;
+            became_fail := TRUE;
+        END IF;
+
+        IF became_success OR became_fail THEN
+            message := _msg.message;
+        END IF;
+    END IF;
+END
+$$;
+
+ALTER FUNCTION cast_vote(_user_id bigint, _message_id bigint, _original_chat_id bigint, _yes boolean, _allow_switch boolean, _votes_required integer, OUT opened boolean, OUT prev_vote boolean, OUT updated boolean, OUT yes_count integer, OUT total_count integer, OUT became_success boolean, OUT became_fail boolean, OUT message jsonb) OWNER TO boterator;
@@ -0,0 +1,77 @@
+ALTER TABLE incoming_messages ADD COLUMN IF NOT EXISTS yes_count integer DEFAULT 0 NOT NULL;
+ALTER TABLE incoming_messages ADD COLUMN IF NOT EXISTS no_count integer DEFAULT 0 NOT NULL;
+
+UPDATE incoming_messages im SET yes_count = vh.yes_count, no_count = vh.no_count
+    FROM (SELECT message_id, original_chat_id, SUM(vote_yes::INT) AS yes_count, SUM((NOT vote_yes)::INT) AS no_count
+          FROM votes_history GROUP BY message_id, original_chat_id) vh
+    WHERE vh.message_id = im.id AND vh.original_chat_id = im.original_chat_id
+    AND (im.yes_count, im.no_count) IS DISTINCT FROM (vh.yes_count::INT, vh.no_count::INT);
+
+CREATE OR REPLACE FUNCTION cast_vote(_user_id bigint, _message_id bigint, _original_chat_id bigint, _yes boolean, _allow_switch boolean, _votes_required integer, OUT opened boolean, OUT prev_vote boolean, OUT updated boolean, OUT yes_count integer, OUT total_count integer, OUT became_success boolean, OUT became_fail boolean, OUT message jsonb) RETURNS record
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    _msg incoming_messages%ROWTYPE;
+BEGIN
+    updated := FALSE;
+    became_success := FALSE;
+    became_fail := FALSE;
+
+    -- Locking the message serializes concurrent votes for it
+    SELECT * INTO _msg FROM incoming_messages
+        WHERE id = _message_id AND original_chat_id = _original_chat_id LIMIT 1 FOR UPDATE;
+    opened := FOUND AND _msg.is_voting_fail = _msg.is_published;
+
+    SELECT vote_yes INTO prev_vote FROM votes_history
+        WHERE user_id = _user_id AND message_id = _message_id AND original_chat_id = _original_chat_id;
+
+    IF opened THEN
+        IF prev_vote IS NULL THEN
+            INSERT INTO votes_history (user_id, message_id, original_chat_id, vote_yes, created_at)
+                VALUES (_user_id, _message_id, _original_chat_id, _yes, NOW())
+                ON CONFLICT (user_id, message_id, original_chat_id) DO NOTHING;
+            updated := FOUND;
+            IF updated AND _yes THEN
+                _msg.yes_count := _msg.yes_count + 1;
+            ELSIF updated THEN
+                _msg.no_count := _msg.no_count + 1;
+            END IF;
+        ELSIF prev_vote <> _yes AND _allow_switch THEN
+            UPDATE votes_history SET vote_yes = _yes
+                WHERE user_id = _user_id AND message_id = _message_id AND original_chat_id = _original_chat_id;
+            updated := TRUE;
+            IF _yes THEN
+                _msg.yes_count := _msg.yes_count + 1;
+                _msg.no_count := _msg.no_count - 1;
+            ELSE
+                _msg.yes_count := _msg.yes_count - 1;
+                _msg.no_count := _msg.no_count + 1;
+            END IF;
+        END IF;
+    END IF;
+
+    yes_count := COALESCE(_msg.yes_count, 0);
+    total_count := COALESCE(_msg.yes_count + _msg.no_count, 0);
+
+    IF opened THEN
+        IF yes_count >= _votes_required THEN
+            became_success := NOT _msg.is_voting_success;
+        ELSIF total_count - yes_count >= _votes_required AND NOT _msg.is_voting_success AND NOT _msg.is_voting_fail THEN
+            became_fail := TRUE;
+        END IF;
+
+        IF updated OR became_success OR became_fail THEN
+            UPDATE incoming_messages SET yes_count = _msg.yes_count, no_count = _msg.no_count,
+                                         is_voting_success = is_voting_success OR became_success,
+                                         is_voting_fail = is_voting_fail OR became_fail
+                WHERE id = _message_id AND original_chat_id = _original_chat_id;
+        END IF;
+
+        IF became_success OR became_fail THEN
+            message := _msg.message;
+        END IF;
+    END IF;
+END
+$$;
+
+ALTER FUNCTION cast_vote(_user_id bigint, _message_id bigint, _original_chat_id bigint, _yes boolean, _allow_switch boolean, _votes_required integer, OUT opened boolean, OUT prev_vote boolean, OUT updated boolean, OUT yes_count integer, OUT total_count integer, OUT became_success boolean, OUT became_fail boolean, OUT message jsonb) OWNER TO boterator;
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS stages_created_at_idx ON stages USING btree (created_at);
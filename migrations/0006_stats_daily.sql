@@ -0,0 +1,119 @@
+CREATE TABLE IF NOT EXISTS stats_daily (
+    bot_id bigint NOT NULL,
+    day date NOT NULL,
+    user_id bigint NOT NULL,
+    votes integer DEFAULT 0 NOT NULL,
+    votes_yes integer DEFAULT 0 NOT NULL,
+    messages integer DEFAULT 0 NOT NULL,
+    published integer DEFAULT 0 NOT NULL,
+    declined integer DEFAULT 0 NOT NULL,
+    CONSTRAINT stats_daily_pkey PRIMARY KEY (bot_id, day, user_id)
+);
+
+ALTER TABLE stats_daily OWNER TO boterator;
+
+CREATE OR REPLACE FUNCTION stats_daily_add(_bot_id bigint, _user_id bigint, _day date, _votes integer, _votes_yes integer, _messages integer, _published integer, _declined integer) RETURNS void
+    LANGUAGE sql
+    AS $$
+    INSERT INTO stats_daily (bot_id, day, user_id, votes, votes_yes, messages, published, declined)
+        VALUES (_bot_id, _day, _user_id, _votes, _votes_yes, _messages, _published, _declined)
+        ON CONFLICT ON CONSTRAINT stats_daily_pkey
+        DO UPDATE SET votes = stats_daily.votes + EXCLUDED.votes, votes_yes = stats_daily.votes_yes + EXCLUDED.votes_yes,
+                      messages = stats_daily.messages + EXCLUDED.messages,
+                      published = stats_daily.published + EXCLUDED.published,
+                      declined = stats_daily.declined + EXCLUDED.declined;
+$$;
+
+ALTER FUNCTION stats_daily_add(_bot_id bigint, _user_id bigint, _day date, _votes integer, _votes_yes integer, _messages integer, _published integer, _declined integer) OWNER TO boterator;
+
+CREATE OR REPLACE FUNCTION stats_daily_messages() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND (OLD.bot_id, OLD.owner_id, OLD.created_at::date) = (NEW.bot_id, NEW.owner_id, NEW.created_at::date) THEN
+        IF (OLD.is_published, OLD.is_voting_fail) IS DISTINCT FROM (NEW.is_published, NEW.is_voting_fail) THEN
+            PERFORM stats_daily_add(NEW.bot_id, NEW.owner_id, NEW.created_at::date, 0, 0, 0,
+                                    NEW.is_published::int - OLD.is_published::int,
+                                    NEW.is_voting_fail::int - OLD.is_voting_fail::int);
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM stats_daily_add(OLD.bot_id, OLD.owner_id, OLD.created_at::date, 0, 0, -1, -OLD.is_published::int,
+                                -OLD.is_voting_fail::int);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM stats_daily_add(NEW.bot_id, NEW.owner_id, NEW.created_at::date, 0, 0, 1, NEW.is_published::int,
+                                NEW.is_voting_fail::int);
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+ALTER FUNCTION stats_daily_messages() OWNER TO boterator;
+
+CREATE OR REPLACE FUNCTION stats_daily_votes() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    _bot_id bigint;
+BEGIN
+    IF TG_OP = 'UPDATE' AND (OLD.message_id, OLD.original_chat_id, OLD.user_id, OLD.created_at::date) =
+                            (NEW.message_id, NEW.original_chat_id, NEW.user_id, NEW.created_at::date) THEN
+        IF OLD.vote_yes <> NEW.vote_yes THEN
+            SELECT bot_id INTO _bot_id FROM incoming_messages
+                WHERE id = NEW.message_id AND original_chat_id = NEW.original_chat_id LIMIT 1;
+            PERFORM stats_daily_add(_bot_id, NEW.user_id, NEW.created_at::date, 0,
+                                    NEW.vote_yes::int - OLD.vote_yes::int, 0, 0, 0)
+                WHERE _bot_id IS NOT NULL;
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        SELECT bot_id INTO _bot_id FROM incoming_messages
+            WHERE id = OLD.message_id AND original_chat_id = OLD.original_chat_id LIMIT 1;
+        PERFORM stats_daily_add(_bot_id, OLD.user_id, OLD.created_at::date, -1, -OLD.vote_yes::int, 0, 0, 0)
+            WHERE _bot_id IS NOT NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT bot_id INTO _bot_id FROM incoming_messages
+            WHERE id = NEW.message_id AND original_chat_id = NEW.original_chat_id LIMIT 1;
+        PERFORM stats_daily_add(_bot_id, NEW.user_id, NEW.created_at::date, 1, NEW.vote_yes::int, 0, 0, 0)
+            WHERE _bot_id IS NOT NULL;
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+ALTER FUNCTION stats_daily_votes() OWNER TO boterator;
+
+BEGIN;
+
+LOCK TABLE incoming_messages, votes_history IN SHARE MODE;
+
+DROP TRIGGER IF EXISTS stats_daily_messages ON incoming_messages;
+CREATE TRIGGER stats_daily_messages AFTER INSERT OR DELETE OR UPDATE OF bot_id, owner_id, created_at, is_published, is_voting_fail
+    ON incoming_messages FOR EACH ROW EXECUTE PROCEDURE stats_daily_messages();
+
+DROP TRIGGER IF EXISTS stats_daily_votes ON votes_history;
+CREATE TRIGGER stats_daily_votes AFTER INSERT OR DELETE OR UPDATE OF user_id, message_id, original_chat_id, vote_yes, created_at
+    ON votes_history FOR EACH ROW EXECUTE PROCEDURE stats_daily_votes();
+
+-- Rebuilt from scratch, so the migration can be applied more than once
+DELETE FROM stats_daily;
+
+INSERT INTO stats_daily (bot_id, day, user_id, votes, votes_yes, messages, published, declined)
+    SELECT bot_id, day, user_id, SUM(votes), SUM(votes_yes), SUM(messages), SUM(published), SUM(declined) FROM (
+        SELECT im.bot_id, vh.created_at::date AS day, vh.user_id, 1 AS votes, vh.vote_yes::int AS votes_yes,
+               0 AS messages, 0 AS published, 0 AS declined
+        FROM votes_history vh
+        JOIN incoming_messages im ON im.id = vh.message_id AND im.original_chat_id = vh.original_chat_id
+        UNION ALL
+        SELECT bot_id, created_at::date, owner_id, 0, 0, 1, is_published::int, is_voting_fail::int
+        FROM incoming_messages
+    ) s
+    GROUP BY bot_id, day, user_id;
+
+COMMIT;
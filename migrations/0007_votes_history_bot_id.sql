@@ -0,0 +1,142 @@
+ALTER TABLE votes_history ADD COLUMN IF NOT EXISTS bot_id bigint;
+
+-- Votes cast by the running version are still stored without bot_id, these are filled in by the backfill
+CREATE INDEX CONCURRENTLY IF NOT EXISTS votes_history_bot_id_null_idx ON votes_history USING btree (id) WHERE bot_id IS NULL;
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS votes_history_bmou_uniq ON votes_history USING btree (bot_id, original_chat_id, message_id, user_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS votes_history_bmov_idx ON votes_history USING btree (bot_id, original_chat_id, message_id, vote_yes);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS votes_history_bcu_idx ON votes_history USING btree (bot_id, created_at, user_id, vote_yes);
+
+-- Fills bot_id for up to _batch_size votes, newest first, returns the number of updated votes
+CREATE OR REPLACE FUNCTION votes_history_backfill_bot_id(_batch_size integer) RETURNS integer
+    LANGUAGE sql
+    AS $$
+    WITH batch AS (
+        SELECT vh.id, im.bot_id FROM votes_history vh
+        JOIN incoming_messages im ON im.id = vh.message_id AND im.original_chat_id = vh.original_chat_id
+        WHERE vh.bot_id IS NULL
+        ORDER BY vh.id DESC
+        LIMIT _batch_size
+        FOR UPDATE OF vh SKIP LOCKED
+    ), updated AS (
+        UPDATE votes_history vh SET bot_id = batch.bot_id FROM batch WHERE vh.id = batch.id RETURNING 1
+    )
+    SELECT COUNT(*)::integer FROM updated;
+$$;
+
+ALTER FUNCTION votes_history_backfill_bot_id(_batch_size integer) OWNER TO boterator;
+
+CREATE OR REPLACE FUNCTION stats_daily_votes() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    _old_bot_id bigint;
+    _new_bot_id bigint;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        _old_bot_id := OLD.bot_id;
+        IF _old_bot_id IS NULL THEN
+            SELECT bot_id INTO _old_bot_id FROM incoming_messages
+                WHERE id = OLD.message_id AND original_chat_id = OLD.original_chat_id LIMIT 1;
+        END IF;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        _new_bot_id := NEW.bot_id;
+        IF _new_bot_id IS NULL THEN
+            SELECT bot_id INTO _new_bot_id FROM incoming_messages
+                WHERE id = NEW.message_id AND original_chat_id = NEW.original_chat_id LIMIT 1;
+        END IF;
+    END IF;
+
+    IF TG_OP = 'UPDATE' AND (_old_bot_id, OLD.user_id, OLD.created_at::date) = (_new_bot_id, NEW.user_id, NEW.created_at::date) THEN
+        IF OLD.vote_yes <> NEW.vote_yes THEN
+            PERFORM stats_daily_add(_new_bot_id, NEW.user_id, NEW.created_at::date, 0,
+                                    NEW.vote_yes::int - OLD.vote_yes::int, 0, 0, 0);
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    IF _old_bot_id IS NOT NULL THEN
+        PERFORM stats_daily_add(_old_bot_id, OLD.user_id, OLD.created_at::date, -1, -OLD.vote_yes::int, 0, 0, 0);
+    END IF;
+    IF _new_bot_id IS NOT NULL THEN
+        PERFORM stats_daily_add(_new_bot_id, NEW.user_id, NEW.created_at::date, 1, NEW.vote_yes::int, 0, 0, 0);
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+ALTER FUNCTION stats_daily_votes() OWNER TO boterator;
+
+CREATE OR REPLACE FUNCTION cast_vote(_bot_id bigint, _user_id bigint, _message_id bigint, _original_chat_id bigint, _yes boolean, _allow_switch boolean, _votes_required integer, OUT opened boolean, OUT prev_vote boolean, OUT updated boolean, OUT yes_count integer, OUT total_count integer, OUT became_success boolean, OUT became_fail boolean, OUT message jsonb) RETURNS record
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    _msg incoming_messages%ROWTYPE;
+BEGIN
+    updated := FALSE;
+    became_success := FALSE;
+    became_fail := FALSE;
+
+    -- Locking the message serializes concurrent votes for it
+    SELECT * INTO _msg FROM incoming_messages
+        WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND id = _message_id FOR UPDATE;
+    opened := FOUND AND _msg.is_voting_fail = _msg.is_published;
+
+    SELECT vote_yes INTO prev_vote FROM votes_history
+        WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND message_id = _message_id
+        AND user_id = _user_id;
+
+    IF opened THEN
+        IF prev_vote IS NULL THEN
+            INSERT INTO votes_history (bot_id, user_id, message_id, original_chat_id, vote_yes, created_at)
+                VALUES (_bot_id, _user_id, _message_id, _original_chat_id, _yes, NOW())
+                ON CONFLICT DO NOTHING;
+            updated := FOUND;
+            IF updated AND _yes THEN
+                _msg.yes_count := _msg.yes_count + 1;
+            ELSIF updated THEN
+                _msg.no_count := _msg.no_count + 1;
+            END IF;
+        ELSIF prev_vote <> _yes AND _allow_switch THEN
+            UPDATE votes_history SET vote_yes = _yes
+                WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND message_id = _message_id
+                AND user_id = _user_id;
+            updated := TRUE;
+            IF _yes THEN
+                _msg.yes_count := _msg.yes_count + 1;
+                _msg.no_count := _msg.no_count - 1;
+            ELSE
+                _msg.yes_count := _msg.yes_count - 1;
+                _msg.no_count := _msg.no_count + 1;
+            END IF;
+        END IF;
+    END IF;
+
+    yes_count := COALESCE(_msg.yes_count, 0);
+    total_count := COALESCE(_msg.yes_count + _msg.no_count, 0);
+
+    IF opened THEN
+        IF yes_count >= _votes_required THEN
+            became_success := NOT _msg.is_voting_success;
+        ELSIF total_count - yes_count >= _votes_required AND NOT _msg.is_voting_success AND NOT _msg.is_voting_fail THEN
+            became_fail := TRUE;
+        END IF;
+
+        IF updated OR became_success OR became_fail THEN
+            UPDATE incoming_messages SET yes_count = _msg.yes_count, no_count = _msg.no_count,
+                                         is_voting_success = is_voting_success OR became_success,
+                                         is_voting_fail = is_voting_fail OR became_fail
+                WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND id = _message_id;
+        END IF;
+
+        IF became_success OR became_fail THEN
+            message := _msg.message;
+        END IF;
+    END IF;
+END
+$$;
+
+ALTER FUNCTION cast_vote(_bot_id bigint, _user_id bigint, _message_id bigint, _original_chat_id bigint, _yes boolean, _allow_switch boolean, _votes_required integer, OUT opened boolean, OUT prev_vote boolean, OUT updated boolean, OUT yes_count integer, OUT total_count integer, OUT became_success boolean, OUT became_fail boolean, OUT message jsonb) OWNER TO boterator;
+
+-- migrate: repeat
+SELECT votes_history_backfill_bot_id(10000);
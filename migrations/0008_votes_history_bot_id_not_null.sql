@@ -0,0 +1,49 @@
+-- Votes not filled in by the batched backfill yet, see readme
+DO $$
+BEGIN
+    IF to_regprocedure('votes_history_backfill_bot_id(integer)') IS NOT NULL THEN
+        WHILE votes_history_backfill_bot_id(10000) > 0 LOOP
+        END LOOP;
+    END IF;
+END
+$$;
+
+-- Votes for messages which don't exist anymore
+DELETE FROM votes_history WHERE bot_id IS NULL;
+
+ALTER TABLE votes_history ALTER COLUMN bot_id SET NOT NULL;
+
+DROP FUNCTION IF EXISTS votes_history_backfill_bot_id(_batch_size integer);
+DROP FUNCTION IF EXISTS cast_vote(_user_id bigint, _message_id bigint, _original_chat_id bigint, _yes boolean, _allow_switch boolean, _votes_required integer, OUT opened boolean, OUT prev_vote boolean, OUT updated boolean, OUT yes_count integer, OUT total_count integer, OUT became_success boolean, OUT became_fail boolean, OUT message jsonb);
+
+DROP INDEX CONCURRENTLY IF EXISTS votes_history_bot_id_null_idx;
+DROP INDEX CONCURRENTLY IF EXISTS votes_history_umo_uniq;
+DROP INDEX CONCURRENTLY IF EXISTS votes_history_mo_idx;
+
+CREATE OR REPLACE FUNCTION stats_daily_votes() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND (OLD.bot_id, OLD.user_id, OLD.created_at::date) = (NEW.bot_id, NEW.user_id, NEW.created_at::date) THEN
+        IF OLD.vote_yes <> NEW.vote_yes THEN
+            PERFORM stats_daily_add(NEW.bot_id, NEW.user_id, NEW.created_at::date, 0,
+                                    NEW.vote_yes::int - OLD.vote_yes::int, 0, 0, 0);
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM stats_daily_add(OLD.bot_id, OLD.user_id, OLD.created_at::date, -1, -OLD.vote_yes::int, 0, 0, 0);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM stats_daily_add(NEW.bot_id, NEW.user_id, NEW.created_at::date, 1, NEW.vote_yes::int, 0, 0, 0);
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+ALTER FUNCTION stats_daily_votes() OWNER TO boterator;
+
+DROP TRIGGER IF EXISTS stats_daily_votes ON votes_history;
+CREATE TRIGGER stats_daily_votes AFTER INSERT OR DELETE OR UPDATE OF bot_id, user_id, vote_yes, created_at
+    ON votes_history FOR EACH ROW EXECUTE PROCEDURE stats_daily_votes();
@@ -0,0 +1,2 @@
+-- Messages of a user, for the msg_freq_limit check
+CREATE INDEX CONCURRENTLY IF NOT EXISTS im_owner_idx ON incoming_messages USING btree (bot_id, owner_id, created_at DESC);
@@ -0,0 +1,201 @@
+-- migrate: manual
+-- Copies both tables under an exclusive lock: stop the slave-holders and the boterator, then run
+--   psql -v ON_ERROR_STOP=1 -U boterator boterator < migrations/0010_partitioning.sql
+BEGIN;
+
+-- Declarative partitioning with indexes and row triggers on the partitioned tables
+DO $$
+BEGIN
+    IF current_setting('server_version_num')::integer < 110000 THEN
+        RAISE EXCEPTION 'PostgreSQL 11 or newer is required';
+    END IF;
+    -- Earlier migrations can't be applied to the partitioned tables
+    IF to_regclass('schema_migrations') IS NULL THEN
+        RAISE EXCEPTION 'Apply the previous migrations first, start any of the servers once';
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM schema_migrations WHERE version = '0009_incoming_messages_owner_idx') THEN
+        RAISE EXCEPTION 'Apply the previous migrations first, start any of the servers once';
+    END IF;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION create_monthly_partitions(_table regclass, _since date, _until date) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    _month date := date_trunc('month', _since);
+    _partition text;
+    _created integer := 0;
+BEGIN
+    -- Slave-holders starting at the same time create the same partitions
+    PERFORM pg_advisory_xact_lock('pg_class'::regclass::integer, hashtext(_table::text));
+
+    WHILE _month <= _until LOOP
+        _partition := _table::text || '_' || to_char(_month, 'YYYY_MM');
+        IF to_regclass(_partition) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF %s FOR VALUES FROM (%L) TO (%L)', _partition, _table, _month,
+                           (_month + INTERVAL '1 month')::date);
+            EXECUTE format('ALTER TABLE %I OWNER TO boterator', _partition);
+            _created := _created + 1;
+        END IF;
+        _month := _month + INTERVAL '1 month';
+    END LOOP;
+
+    RETURN _created;
+END
+$$;
+
+ALTER FUNCTION create_monthly_partitions(_table regclass, _since date, _until date) OWNER TO boterator;
+
+-- Tables are copied into monthly partitioned ones
+DO $$
+DECLARE
+    _until date := date_trunc('month', NOW()) + INTERVAL '3 months';
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'incoming_messages'::regclass) = 'p' THEN
+        RETURN;
+    END IF;
+
+    LOCK TABLE incoming_messages, votes_history IN ACCESS EXCLUSIVE MODE;
+
+    ALTER TABLE incoming_messages RENAME TO incoming_messages_unpartitioned;
+    CREATE TABLE incoming_messages (LIKE incoming_messages_unpartitioned INCLUDING DEFAULTS)
+        PARTITION BY RANGE (created_at);
+    ALTER TABLE incoming_messages OWNER TO boterator;
+    PERFORM create_monthly_partitions('incoming_messages', COALESCE(
+        (SELECT MIN(created_at) FROM incoming_messages_unpartitioned)::date, _until), _until);
+    INSERT INTO incoming_messages SELECT * FROM incoming_messages_unpartitioned;
+
+    -- Primary key of the partitioned table can't keep messages unique, this table does
+    CREATE TABLE incoming_message_keys (
+        bot_id bigint NOT NULL,
+        original_chat_id bigint NOT NULL,
+        id integer NOT NULL,
+        created_at timestamp without time zone NOT NULL,
+        CONSTRAINT incoming_message_keys_pkey PRIMARY KEY (bot_id, original_chat_id, id)
+    );
+    ALTER TABLE incoming_message_keys OWNER TO boterator;
+    INSERT INTO incoming_message_keys (bot_id, original_chat_id, id, created_at)
+        SELECT bot_id, original_chat_id, id, created_at FROM incoming_messages_unpartitioned;
+
+    -- Votes are partitioned by the time of their message, so a vote can be unique within a single partition
+    ALTER TABLE votes_history RENAME TO votes_history_unpartitioned;
+    CREATE TABLE votes_history (
+        LIKE votes_history_unpartitioned INCLUDING DEFAULTS,
+        message_created_at timestamp without time zone NOT NULL
+    ) PARTITION BY RANGE (message_created_at);
+    ALTER TABLE votes_history OWNER TO boterator;
+    PERFORM create_monthly_partitions('votes_history', COALESCE(LEAST(
+        (SELECT MIN(created_at) FROM incoming_messages_unpartitioned),
+        (SELECT MIN(created_at) FROM votes_history_unpartitioned))::date, _until), _until);
+    INSERT INTO votes_history
+        SELECT v.*, COALESCE(im.created_at, v.created_at) FROM votes_history_unpartitioned v
+        LEFT JOIN incoming_messages_unpartitioned im
+            ON im.bot_id = v.bot_id AND im.original_chat_id = v.original_chat_id AND im.id = v.message_id;
+    ALTER SEQUENCE votes_history_id_seq OWNED BY NONE;
+    DROP TABLE votes_history_unpartitioned;
+    DROP TABLE incoming_messages_unpartitioned;
+    ALTER SEQUENCE votes_history_id_seq OWNED BY votes_history.id;
+
+    -- Unique constraints of partitioned tables have to include the partition key
+    ALTER TABLE incoming_messages ADD CONSTRAINT incoming_messages_pkey
+        PRIMARY KEY (bot_id, original_chat_id, id, created_at);
+    CREATE INDEX im_owner_idx ON incoming_messages USING btree (bot_id, owner_id, created_at DESC);
+    CREATE INDEX im_pending_die_idx ON incoming_messages USING btree (bot_id, is_voting_success, is_voting_fail, created_at DESC);
+    CREATE INDEX im_pending_idx ON incoming_messages USING btree (bot_id, is_voting_success, is_published, created_at);
+
+    ALTER TABLE votes_history ADD CONSTRAINT votes_history_pkey PRIMARY KEY (id, message_created_at);
+    CREATE INDEX votes_history_bcu_idx ON votes_history USING btree (bot_id, created_at, user_id, vote_yes);
+    CREATE UNIQUE INDEX votes_history_bmou_uniq ON votes_history
+        USING btree (bot_id, original_chat_id, message_id, user_id, message_created_at);
+    CREATE INDEX votes_history_bmov_idx ON votes_history USING btree (bot_id, original_chat_id, message_id, vote_yes);
+
+    -- Created after the data is copied, stats_daily already counts it
+    CREATE TRIGGER stats_daily_messages AFTER INSERT OR DELETE OR UPDATE OF bot_id, owner_id, created_at, is_published, is_voting_fail
+        ON incoming_messages FOR EACH ROW EXECUTE PROCEDURE stats_daily_messages();
+    CREATE TRIGGER stats_daily_votes AFTER INSERT OR DELETE OR UPDATE OF bot_id, user_id, vote_yes, created_at
+        ON votes_history FOR EACH ROW EXECUTE PROCEDURE stats_daily_votes();
+END
+$$;
+
+CREATE OR REPLACE FUNCTION cast_vote(_bot_id bigint, _user_id bigint, _message_id bigint, _original_chat_id bigint, _yes boolean, _allow_switch boolean, _votes_required integer, OUT opened boolean, OUT prev_vote boolean, OUT updated boolean, OUT yes_count integer, OUT total_count integer, OUT became_success boolean, OUT became_fail boolean, OUT message jsonb) RETURNS record
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    _msg incoming_messages%ROWTYPE;
+    _created_at timestamp without time zone;
+BEGIN
+    updated := FALSE;
+    became_success := FALSE;
+    became_fail := FALSE;
+
+    -- The key gives the partition of the message and of its votes. Locking the message serializes concurrent
+    -- votes for it.
+    SELECT created_at INTO _created_at FROM incoming_message_keys
+        WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND id = _message_id;
+    SELECT * INTO _msg FROM incoming_messages
+        WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND id = _message_id
+        AND created_at = _created_at FOR UPDATE;
+    opened := FOUND AND _msg.is_voting_fail = _msg.is_published;
+
+    SELECT vote_yes INTO prev_vote FROM votes_history
+        WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND message_id = _message_id
+        AND user_id = _user_id AND message_created_at = _created_at;
+
+    IF opened THEN
+        IF prev_vote IS NULL THEN
+            INSERT INTO votes_history (bot_id, user_id, message_id, original_chat_id, vote_yes, created_at,
+                                       message_created_at)
+                VALUES (_bot_id, _user_id, _message_id, _original_chat_id, _yes, NOW(), _created_at)
+                ON CONFLICT DO NOTHING;
+            updated := FOUND;
+            IF updated AND _yes THEN
+                _msg.yes_count := _msg.yes_count + 1;
+            ELSIF updated THEN
+                _msg.no_count := _msg.no_count + 1;
+            END IF;
+        ELSIF prev_vote <> _yes AND _allow_switch THEN
+            UPDATE votes_history SET vote_yes = _yes
+                WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND message_id = _message_id
+                AND user_id = _user_id AND message_created_at = _created_at;
+            updated := TRUE;
+            IF _yes THEN
+                _msg.yes_count := _msg.yes_count + 1;
+                _msg.no_count := _msg.no_count - 1;
+            ELSE
+                _msg.yes_count := _msg.yes_count - 1;
+                _msg.no_count := _msg.no_count + 1;
+            END IF;
+        END IF;
+    END IF;
+
+    yes_count := COALESCE(_msg.yes_count, 0);
+    total_count := COALESCE(_msg.yes_count + _msg.no_count, 0);
+
+    IF opened THEN
+        IF yes_count >= _votes_required THEN
+            became_success := NOT _msg.is_voting_success;
+        ELSIF total_count - yes_count >= _votes_required AND NOT _msg.is_voting_success AND NOT _msg.is_voting_fail THEN
+            became_fail := TRUE;
+        END IF;
+
+        IF updated OR became_success OR became_fail THEN
+            UPDATE incoming_messages SET yes_count = _msg.yes_count, no_count = _msg.no_count,
+                                         is_voting_success = is_voting_success OR became_success,
+                                         is_voting_fail = is_voting_fail OR became_fail
+                WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND id = _message_id
+                AND created_at = _created_at;
+        END IF;
+
+        IF became_success OR became_fail THEN
+            message := _msg.message;
+        END IF;
+    END IF;
+END
+$$;
+
+ALTER FUNCTION cast_vote(_bot_id bigint, _user_id bigint, _message_id bigint, _original_chat_id bigint, _yes boolean, _allow_switch boolean, _votes_required integer, OUT opened boolean, OUT prev_vote boolean, OUT updated boolean, OUT yes_count integer, OUT total_count integer, OUT became_success boolean, OUT became_fail boolean, OUT message jsonb) OWNER TO boterator;
+
+INSERT INTO schema_migrations (version) VALUES ('0010_partitioning') ON CONFLICT DO NOTHING;
+
+COMMIT;
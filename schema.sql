@@ -2,7 +2,7 @@
 -- PostgreSQL database dump
 --
 
--- Dumped from database version 9.5.2
+-- Dumped from database version 12.4
 -- Dumped by pg_dump version 9.6.5
 
 SET statement_timeout = 0;
@@ -29,10 +29,221 @@ COMMENT ON EXTENSION plpgsql IS 'PL/pgSQL procedural language';
 
 SET search_path = public, pg_catalog;
 
+--
+-- Name: cast_vote(_bot_id bigint, _user_id bigint, _message_id bigint, _original_chat_id bigint, _yes boolean, _allow_switch boolean, _votes_required integer, OUT opened boolean, OUT prev_vote boolean, OUT updated boolean, OUT yes_count integer, OUT total_count integer, OUT became_success boolean, OUT became_fail boolean, OUT message jsonb); Type: FUNCTION; Schema: public; Owner: boterator
+--
+
+CREATE FUNCTION cast_vote(_bot_id bigint, _user_id bigint, _message_id bigint, _original_chat_id bigint, _yes boolean, _allow_switch boolean, _votes_required integer, OUT opened boolean, OUT prev_vote boolean, OUT updated boolean, OUT yes_count integer, OUT total_count integer, OUT became_success boolean, OUT became_fail boolean, OUT message jsonb) RETURNS record
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    _msg incoming_messages%ROWTYPE;
+    _created_at timestamp without time zone;
+BEGIN
+    updated := FALSE;
+    became_success := FALSE;
+    became_fail := FALSE;
+
+    -- The key gives the partition of the message and of its votes. Locking the message serializes concurrent
+    -- votes for it.
+    SELECT created_at INTO _created_at FROM incoming_message_keys
+        WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND id = _message_id;
+    SELECT * INTO _msg FROM incoming_messages
+        WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND id = _message_id
+        AND created_at = _created_at FOR UPDATE;
+    opened := FOUND AND _msg.is_voting_fail = _msg.is_published;
+
+    SELECT vote_yes INTO prev_vote FROM votes_history
+        WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND message_id = _message_id
+        AND user_id = _user_id AND message_created_at = _created_at;
+
+    IF opened THEN
+        IF prev_vote IS NULL THEN
+            INSERT INTO votes_history (bot_id, user_id, message_id, original_chat_id, vote_yes, created_at,
+                                       message_created_at)
+                VALUES (_bot_id, _user_id, _message_id, _original_chat_id, _yes, NOW(), _created_at)
+                ON CONFLICT DO NOTHING;
+            updated := FOUND;
+            IF updated AND _yes THEN
+                _msg.yes_count := _msg.yes_count + 1;
+            ELSIF updated THEN
+                _msg.no_count := _msg.no_count + 1;
+            END IF;
+        ELSIF prev_vote <> _yes AND _allow_switch THEN
+            UPDATE votes_history SET vote_yes = _yes
+                WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND message_id = _message_id
+                AND user_id = _user_id AND message_created_at = _created_at;
+            updated := TRUE;
+            IF _yes THEN
+                _msg.yes_count := _msg.yes_count + 1;
+                _msg.no_count := _msg.no_count - 1;
+            ELSE
+                _msg.yes_count := _msg.yes_count - 1;
+                _msg.no_count := _msg.no_count + 1;
+            END IF;
+        END IF;
+    END IF;
+
+    yes_count := COALESCE(_msg.yes_count, 0);
+    total_count := COALESCE(_msg.yes_count + _msg.no_count, 0);
+
+    IF opened THEN
+        IF yes_count >= _votes_required THEN
+            became_success := NOT _msg.is_voting_success;
+        ELSIF total_count - yes_count >= _votes_required AND NOT _msg.is_voting_success AND NOT _msg.is_voting_fail THEN
+            became_fail := TRUE;
+        END IF;
+
+        IF updated OR became_success OR became_fail THEN
+            UPDATE incoming_messages SET yes_count = _msg.yes_count, no_count = _msg.no_count,
+                                         is_voting_success = is_voting_success OR became_success,
+                                         is_voting_fail = is_voting_fail OR became_fail
+                WHERE bot_id = _bot_id AND original_chat_id = _original_chat_id AND id = _message_id
+                AND created_at = _created_at;
+        END IF;
+
+        IF became_success OR became_fail THEN
+            message := _msg.message;
+        END IF;
+    END IF;
+END
+$$;
+
+
+ALTER FUNCTION cast_vote(_bot_id bigint, _user_id bigint, _message_id bigint, _original_chat_id bigint, _yes boolean, _allow_switch boolean, _votes_required integer, OUT opened boolean, OUT prev_vote boolean, OUT updated boolean, OUT yes_count integer, OUT total_count integer, OUT became_success boolean, OUT became_fail boolean, OUT message jsonb) OWNER TO boterator;
+
+--
+-- Name: create_monthly_partitions(_table regclass, _since date, _until date); Type: FUNCTION; Schema: public; Owner: boterator
+--
+
+CREATE FUNCTION create_monthly_partitions(_table regclass, _since date, _until date) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    _month date := date_trunc('month', _since);
+    _partition text;
+    _created integer := 0;
+BEGIN
+    -- Slave-holders starting at the same time create the same partitions
+    PERFORM pg_advisory_xact_lock('pg_class'::regclass::integer, hashtext(_table::text));
+
+    WHILE _month <= _until LOOP
+        _partition := _table::text || '_' || to_char(_month, 'YYYY_MM');
+        IF to_regclass(_partition) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF %s FOR VALUES FROM (%L) TO (%L)', _partition, _table, _month,
+                           (_month + INTERVAL '1 month')::date);
+            EXECUTE format('ALTER TABLE %I OWNER TO boterator', _partition);
+            _created := _created + 1;
+        END IF;
+        _month := _month + INTERVAL '1 month';
+    END LOOP;
+
+    RETURN _created;
+END
+$$;
+
+
+ALTER FUNCTION create_monthly_partitions(_table regclass, _since date, _until date) OWNER TO boterator;
+
+--
+-- Name: stats_daily_add(_bot_id bigint, _user_id bigint, _day date, _votes integer, _votes_yes integer, _messages integer, _published integer, _declined integer); Type: FUNCTION; Schema: public; Owner: boterator
+--
+
+CREATE FUNCTION stats_daily_add(_bot_id bigint, _user_id bigint, _day date, _votes integer, _votes_yes integer, _messages integer, _published integer, _declined integer) RETURNS void
+    LANGUAGE sql
+    AS $$
+    INSERT INTO stats_daily (bot_id, day, user_id, votes, votes_yes, messages, published, declined)
+        VALUES (_bot_id, _day, _user_id, _votes, _votes_yes, _messages, _published, _declined)
+        ON CONFLICT ON CONSTRAINT stats_daily_pkey
+        DO UPDATE SET votes = stats_daily.votes + EXCLUDED.votes, votes_yes = stats_daily.votes_yes + EXCLUDED.votes_yes,
+                      messages = stats_daily.messages + EXCLUDED.messages,
+                      published = stats_daily.published + EXCLUDED.published,
+                      declined = stats_daily.declined + EXCLUDED.declined;
+$$;
+
+
+ALTER FUNCTION stats_daily_add(_bot_id bigint, _user_id bigint, _day date, _votes integer, _votes_yes integer, _messages integer, _published integer, _declined integer) OWNER TO boterator;
+
+--
+-- Name: stats_daily_messages(); Type: FUNCTION; Schema: public; Owner: boterator
+--
+
+CREATE FUNCTION stats_daily_messages() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND (OLD.bot_id, OLD.owner_id, OLD.created_at::date) = (NEW.bot_id, NEW.owner_id, NEW.created_at::date) THEN
+        IF (OLD.is_published, OLD.is_voting_fail) IS DISTINCT FROM (NEW.is_published, NEW.is_voting_fail) THEN
+            PERFORM stats_daily_add(NEW.bot_id, NEW.owner_id, NEW.created_at::date, 0, 0, 0,
+                                    NEW.is_published::int - OLD.is_published::int,
+                                    NEW.is_voting_fail::int - OLD.is_voting_fail::int);
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM stats_daily_add(OLD.bot_id, OLD.owner_id, OLD.created_at::date, 0, 0, -1, -OLD.is_published::int,
+                                -OLD.is_voting_fail::int);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM stats_daily_add(NEW.bot_id, NEW.owner_id, NEW.created_at::date, 0, 0, 1, NEW.is_published::int,
+                                NEW.is_voting_fail::int);
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+
+ALTER FUNCTION stats_daily_messages() OWNER TO boterator;
+
+--
+-- Name: stats_daily_votes(); Type: FUNCTION; Schema: public; Owner: boterator
+--
+
+CREATE FUNCTION stats_daily_votes() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND (OLD.bot_id, OLD.user_id, OLD.created_at::date) = (NEW.bot_id, NEW.user_id, NEW.created_at::date) THEN
+        IF OLD.vote_yes <> NEW.vote_yes THEN
+            PERFORM stats_daily_add(NEW.bot_id, NEW.user_id, NEW.created_at::date, 0,
+                                    NEW.vote_yes::int - OLD.vote_yes::int, 0, 0, 0);
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM stats_daily_add(OLD.bot_id, OLD.user_id, OLD.created_at::date, -1, -OLD.vote_yes::int, 0, 0, 0);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM stats_daily_add(NEW.bot_id, NEW.user_id, NEW.created_at::date, 1, NEW.vote_yes::int, 0, 0, 0);
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+
+ALTER FUNCTION stats_daily_votes() OWNER TO boterator;
+
+
 SET default_tablespace = '';
 
 SET default_with_oids = false;
 
+--
+-- Name: incoming_message_keys; Type: TABLE; Schema: public; Owner: boterator
+--
+
+CREATE TABLE incoming_message_keys (
+    bot_id bigint NOT NULL,
+    original_chat_id bigint NOT NULL,
+    id integer NOT NULL,
+    created_at timestamp without time zone NOT NULL
+);
+
+
+ALTER TABLE incoming_message_keys OWNER TO boterator;
+
 --
 -- Name: incoming_messages; Type: TABLE; Schema: public; Owner: boterator
 --
@@ -48,8 +259,11 @@ CREATE TABLE incoming_messages (
     is_voting_success boolean DEFAULT false NOT NULL,
     message jsonb,
     moderation_message_id integer,
-    moderation_fwd_message_id integer
-);
+    moderation_fwd_message_id integer,
+    yes_count integer DEFAULT 0 NOT NULL,
+    no_count integer DEFAULT 0 NOT NULL
+)
+PARTITION BY RANGE (created_at);
 
 
 ALTER TABLE incoming_messages OWNER TO boterator;
@@ -67,12 +281,43 @@ CREATE TABLE registered_bots (
     active boolean NOT NULL,
     last_moderation_message_at timestamp without time zone,
     last_channel_message_at timestamp without time zone,
-    settings jsonb DEFAULT '{}'::jsonb NOT NULL
+    settings jsonb DEFAULT '{}'::jsonb NOT NULL,
+    moderator_chat_type character varying,
+    moderator_chat_admins bigint[],
+    moderator_chat_updated_at timestamp without time zone
 );
 
 
 ALTER TABLE registered_bots OWNER TO boterator;
 
+--
+-- Name: schema_migrations; Type: TABLE; Schema: public; Owner: boterator
+--
+
+CREATE TABLE schema_migrations (
+    version character varying NOT NULL,
+    applied_at timestamp without time zone DEFAULT now() NOT NULL
+);
+
+
+ALTER TABLE schema_migrations OWNER TO boterator;
+
+--
+-- Name: slave_holders; Type: TABLE; Schema: public; Owner: boterator
+--
+
+CREATE TABLE slave_holders (
+    holder_id character varying NOT NULL,
+    backend_pid integer NOT NULL,
+    capacity integer NOT NULL,
+    bots_count integer NOT NULL,
+    updates_rate real DEFAULT 0 NOT NULL,
+    heartbeat_at timestamp without time zone NOT NULL
+);
+
+
+ALTER TABLE slave_holders OWNER TO boterator;
+
 --
 -- Name: stages; Type: TABLE; Schema: public; Owner: boterator
 --
@@ -88,6 +333,24 @@ CREATE TABLE stages (
 
 ALTER TABLE stages OWNER TO boterator;
 
+--
+-- Name: stats_daily; Type: TABLE; Schema: public; Owner: boterator
+--
+
+CREATE TABLE stats_daily (
+    bot_id bigint NOT NULL,
+    day date NOT NULL,
+    user_id bigint NOT NULL,
+    votes integer DEFAULT 0 NOT NULL,
+    votes_yes integer DEFAULT 0 NOT NULL,
+    messages integer DEFAULT 0 NOT NULL,
+    published integer DEFAULT 0 NOT NULL,
+    declined integer DEFAULT 0 NOT NULL
+);
+
+
+ALTER TABLE stats_daily OWNER TO boterator;
+
 --
 -- Name: users; Type: TABLE; Schema: public; Owner: boterator
 --
@@ -118,8 +381,11 @@ CREATE TABLE votes_history (
     message_id bigint NOT NULL,
     original_chat_id bigint NOT NULL,
     created_at timestamp without time zone NOT NULL,
-    vote_yes boolean NOT NULL
-);
+    vote_yes boolean NOT NULL,
+    bot_id bigint NOT NULL,
+    message_created_at timestamp without time zone NOT NULL
+)
+PARTITION BY RANGE (message_created_at);
 
 
 ALTER TABLE votes_history OWNER TO boterator;
@@ -152,12 +418,36 @@ ALTER SEQUENCE votes_history_id_seq OWNED BY votes_history.id;
 ALTER TABLE ONLY votes_history ALTER COLUMN id SET DEFAULT nextval('votes_history_id_seq'::regclass);
 
 
+--
+-- Data for Name: schema_migrations; Type: TABLE DATA; Schema: public; Owner: boterator
+--
+
+INSERT INTO schema_migrations (version) VALUES ('0001_slave_holders');
+INSERT INTO schema_migrations (version) VALUES ('0002_moderator_chat_info');
+INSERT INTO schema_migrations (version) VALUES ('0003_cast_vote');
+INSERT INTO schema_migrations (version) VALUES ('0004_vote_counters');
+INSERT INTO schema_migrations (version) VALUES ('0005_stages_created_at');
+INSERT INTO schema_migrations (version) VALUES ('0006_stats_daily');
+INSERT INTO schema_migrations (version) VALUES ('0007_votes_history_bot_id');
+INSERT INTO schema_migrations (version) VALUES ('0008_votes_history_bot_id_not_null');
+INSERT INTO schema_migrations (version) VALUES ('0009_incoming_messages_owner_idx');
+INSERT INTO schema_migrations (version) VALUES ('0010_partitioning');
+
+
+--
+-- Name: incoming_message_keys incoming_message_keys_pkey; Type: CONSTRAINT; Schema: public; Owner: boterator
+--
+
+ALTER TABLE ONLY incoming_message_keys
+    ADD CONSTRAINT incoming_message_keys_pkey PRIMARY KEY (bot_id, original_chat_id, id);
+
+
 --
 -- Name: incoming_messages incoming_messages_pkey; Type: CONSTRAINT; Schema: public; Owner: boterator
 --
 
-ALTER TABLE ONLY incoming_messages
-    ADD CONSTRAINT incoming_messages_pkey PRIMARY KEY (bot_id, original_chat_id, id);
+ALTER TABLE incoming_messages
+    ADD CONSTRAINT incoming_messages_pkey PRIMARY KEY (bot_id, original_chat_id, id, created_at);
 
 
 --
@@ -168,6 +458,22 @@ ALTER TABLE ONLY registered_bots
     ADD CONSTRAINT registered_bots_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: schema_migrations schema_migrations_pkey; Type: CONSTRAINT; Schema: public; Owner: boterator
+--
+
+ALTER TABLE ONLY schema_migrations
+    ADD CONSTRAINT schema_migrations_pkey PRIMARY KEY (version);
+
+
+--
+-- Name: slave_holders slave_holders_pkey; Type: CONSTRAINT; Schema: public; Owner: boterator
+--
+
+ALTER TABLE ONLY slave_holders
+    ADD CONSTRAINT slave_holders_pkey PRIMARY KEY (holder_id);
+
+
 --
 -- Name: stages stages_pkey; Type: CONSTRAINT; Schema: public; Owner: boterator
 --
@@ -176,6 +482,14 @@ ALTER TABLE ONLY stages
     ADD CONSTRAINT stages_pkey PRIMARY KEY (bot_id, key);
 
 
+--
+-- Name: stats_daily stats_daily_pkey; Type: CONSTRAINT; Schema: public; Owner: boterator
+--
+
+ALTER TABLE ONLY stats_daily
+    ADD CONSTRAINT stats_daily_pkey PRIMARY KEY (bot_id, day, user_id);
+
+
 --
 -- Name: users users_pkey; Type: CONSTRAINT; Schema: public; Owner: boterator
 --
@@ -188,8 +502,15 @@ ALTER TABLE ONLY users
 -- Name: votes_history votes_history_pkey; Type: CONSTRAINT; Schema: public; Owner: boterator
 --
 
-ALTER TABLE ONLY votes_history
-    ADD CONSTRAINT votes_history_pkey PRIMARY KEY (id);
+ALTER TABLE votes_history
+    ADD CONSTRAINT votes_history_pkey PRIMARY KEY (id, message_created_at);
+
+
+--
+-- Name: im_owner_idx; Type: INDEX; Schema: public; Owner: boterator
+--
+
+CREATE INDEX im_owner_idx ON incoming_messages USING btree (bot_id, owner_id, created_at DESC);
 
 
 --
@@ -206,6 +527,13 @@ CREATE INDEX im_pending_die_idx ON incoming_messages USING btree (bot_id, is_vot
 CREATE INDEX im_pending_idx ON incoming_messages USING btree (bot_id, is_voting_success, is_published, created_at);
 
 
+--
+-- Name: stages_created_at_idx; Type: INDEX; Schema: public; Owner: boterator
+--
+
+CREATE INDEX stages_created_at_idx ON stages USING btree (created_at);
+
+
 --
 -- Name: rb_active_idx; Type: INDEX; Schema: public; Owner: boterator
 --
@@ -228,17 +556,46 @@ CREATE INDEX users_banned_idx ON users USING btree (bot_id, banned_at);
 
 
 --
--- Name: votes_history_mo_idx; Type: INDEX; Schema: public; Owner: boterator
+-- Name: votes_history_bcu_idx; Type: INDEX; Schema: public; Owner: boterator
+--
+
+CREATE INDEX votes_history_bcu_idx ON votes_history USING btree (bot_id, created_at, user_id, vote_yes);
+
+
+--
+-- Name: votes_history_bmou_uniq; Type: INDEX; Schema: public; Owner: boterator
+--
+
+CREATE UNIQUE INDEX votes_history_bmou_uniq ON votes_history USING btree (bot_id, original_chat_id, message_id, user_id, message_created_at);
+
+
+--
+-- Name: votes_history_bmov_idx; Type: INDEX; Schema: public; Owner: boterator
+--
+
+CREATE INDEX votes_history_bmov_idx ON votes_history USING btree (bot_id, original_chat_id, message_id, vote_yes);
+
+
+--
+-- Name: incoming_messages stats_daily_messages; Type: TRIGGER; Schema: public; Owner: boterator
+--
+
+CREATE TRIGGER stats_daily_messages AFTER INSERT OR DELETE OR UPDATE OF bot_id, owner_id, created_at, is_published, is_voting_fail ON incoming_messages FOR EACH ROW EXECUTE PROCEDURE stats_daily_messages();
+
+
+--
+-- Name: votes_history stats_daily_votes; Type: TRIGGER; Schema: public; Owner: boterator
 --
 
-CREATE INDEX votes_history_mo_idx ON votes_history USING btree (message_id, original_chat_id);
+CREATE TRIGGER stats_daily_votes AFTER INSERT OR DELETE OR UPDATE OF bot_id, user_id, vote_yes, created_at ON votes_history FOR EACH ROW EXECUTE PROCEDURE stats_daily_votes();
 
 
 --
--- Name: votes_history_umo_idx; Type: INDEX; Schema: public; Owner: boterator
+-- Name: incoming_messages, votes_history; Type: PARTITIONS; Schema: public; Owner: boterator
 --
 
-CREATE INDEX votes_history_umo_idx ON votes_history USING btree (user_id, message_id, original_chat_id);
+SELECT create_monthly_partitions('incoming_messages', CURRENT_DATE, (CURRENT_DATE + INTERVAL '3 months')::date);
+SELECT create_monthly_partitions('votes_history', CURRENT_DATE, (CURRENT_DATE + INTERVAL '3 months')::date);
 
 
 --
@@ -9,16 +9,14 @@ from tornado.ioloop import IOLoop
 from tornado.options import define, options, parse_command_line
 from os import environ
 
+from core.leases import BotLeases
+from core.migrations import apply_migrations
+from core.notifications import PgListener
 from core.slave_holder import SlaveHolder
+from core.supervisor import fork_workers
 
 
-if __name__ == '__main__':
-    define('db', type=str, help='DB connection DSN', default=environ.get('DB', "dbname=boterator user=boterator host=localhost port=5432"))
-    define('burlesque', type=str, help='Burlesque address', default=environ.get('BURLESQUE', 'http://127.0.0.1:4401'))
-    define('debug', type=bool, default=False)
-
-    parse_command_line()
-
+def run_slave_holder(shard=0, shards_count=1):
     AsyncHTTPClient.configure(None, max_clients=1024)
 
     ioloop = IOLoop.instance()
@@ -26,16 +24,76 @@ if __name__ == '__main__':
     db = Pool(dsn=options.db, size=1, max_size=10, auto_shrink=True, ioloop=IOLoop.current())
     ioloop.run_sync(db.connect)
 
-    if options.debug:
+    if options.debug and shards_count == 1:
         autoreload.start()
 
-    sh = SlaveHolder(db, Burlesque(options.burlesque))
+    holder_options = dict(startup_concurrency=options.startup_concurrency, startup_rate=options.startup_rate,
+                          hibernate_after=options.hibernate_after,
+                          hibernation_poll_interval=options.hibernation_poll_interval,
+                          edit_window=options.edit_window, early_callback_answer=options.early_callback_answer,
+                          notifications=PgListener(options.db))
+    if options.webhook_url:
+        holder_options.update(webhook_url=options.webhook_url.format(worker=shard),
+                       webhook_port=options.webhook_port + shard)
+    if options.lease:
+        sh = SlaveHolder(db, Burlesque(options.burlesque), leases=BotLeases(options.db, options.lease_capacity),
+                         rebalance_interval=options.rebalance_interval, **holder_options)
+    else:
+        sh = SlaveHolder(db, Burlesque(options.burlesque), shard=shard, shards_count=shards_count, **holder_options)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: ioloop.add_callback_from_signal(sh.stop))
+    signal.signal(signal.SIGINT, lambda signum, frame: ioloop.add_callback_from_signal(sh.stop))
+
     try:
         ioloop.run_sync(sh.start)
-    except Exception as e:
-        if not isinstance(e, KeyboardInterrupt):
-            logging.exception('Got exception')
+    except Exception:
+        logging.exception('Got exception')
         sh.stop()
+        raise
+
+
+if __name__ == '__main__':
+    define('db', type=str, help='DB connection DSN', default=environ.get('DB', "dbname=boterator user=boterator host=localhost port=5432"))
+    define('burlesque', type=str, help='Burlesque address', default=environ.get('BURLESQUE', 'http://127.0.0.1:4401'))
+    define('debug', type=bool, default=False)
+    define('migrate', type=bool, help='Apply new DB migrations on startup', default=environ.get('MIGRATE', '1') == '1')
+    define('workers', type=int, help='Amount of worker processes, each one serves its own shard of bots',
+           default=int(environ.get('WORKERS', 1)))
+    define('lease', type=bool, help='Lease bots through the DB instead of sharding them, allows to run slave-holders '
+                                    'on several nodes', default=environ.get('LEASE') == '1')
+    define('lease_capacity', type=int, help='Max amount of bots leased by a single slave-holder process',
+           default=int(environ.get('LEASE_CAPACITY', 1000)))
+    define('rebalance_interval', type=int, help='How often (in seconds) a leasing slave-holder moves its noisiest bots '
+                                                'to less loaded peers, 0 to disable',
+           default=int(environ.get('REBALANCE_INTERVAL', 300)))
+    define('startup_concurrency', type=int, help='Max amount of bots warming up (fetching moderators chat info) '
+                                                 'at the same time',
+           default=int(environ.get('STARTUP_CONCURRENCY', 20)))
+    define('startup_rate', type=float, help='Max amount of bots started per second, 0 for unlimited',
+           default=float(environ.get('STARTUP_RATE', 10)))
+    define('webhook_url', type=str, help='Receive updates through webhooks instead of long polling: public base URL '
+                                         'of the slave-holder, {worker} is replaced with the worker id',
+           default=environ.get('WEBHOOK_URL'))
+    define('webhook_port', type=int, help='Port for incoming webhooks, worker N listens on webhook_port + N',
+           default=int(environ.get('WEBHOOK_PORT', 8443)))
+    define('hibernate_after', type=int, help='Stop long polling for bots without updates for this amount of seconds, '
+                                             '0 to always keep the long poll',
+           default=int(environ.get('HIBERNATE_AFTER', 0)))
+    define('hibernation_poll_interval', type=int, help='How often (in seconds) a hibernating bot checks for updates',
+           default=int(environ.get('HIBERNATION_POLL_INTERVAL', 60)))
+    define('edit_window', type=float, help='Delay (in seconds) of poll message edits, several edits of the same '
+                                           'message within this time are sent as one',
+           default=float(environ.get('EDIT_WINDOW', 0.5)))
+    define('early_callback_answer', type=bool, help='Answer moderators button taps before the poll message is updated',
+           default=environ.get('EARLY_CALLBACK_ANSWER', '1') == '1')
+
+    parse_command_line()
+
+    if options.migrate:
+        apply_migrations(options.db)
 
-    signal.signal(signal.SIGTERM, sh.stop)
-    signal.signal(signal.SIGINT, sh.stop)
+    if options.workers > 1:
+        worker_id = fork_workers(options.workers)
+        run_slave_holder(worker_id, options.workers)
+    else:
+        run_slave_holder()